@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Compare parsing osquery's calendarTime with strptime, as extract_results
+used to, against doorman.utils.parse_calendar_time.
+
+    python benchmarks/calendar_time.py [entries] [distinct timestamps]
+"""
+import datetime as dt
+import sys
+import timeit
+
+from doorman.utils import parse_calendar_time
+
+
+def make_values(count, distinct):
+    start = dt.datetime(2016, 7, 18, 9, 59, 6)
+    return ['%s UTC' % (start + dt.timedelta(seconds=i % distinct)).ctime()
+            for i in range(count)]
+
+
+def strptime(values):
+    for value in values:
+        dt.datetime.strptime(value, '%a %b %d %H:%M:%S %Y UTC')
+
+
+def memoized(values):
+    for value in values:
+        parse_calendar_time(value)
+
+
+def main(count=10000, distinct=10):
+    values = make_values(count, distinct)
+
+    for func in (strptime, memoized):
+        best = min(timeit.repeat(lambda: func(values), number=1, repeat=5))
+        print('{0:>10}: {1:8.2f} ms, {2:10.0f} entries/sec'.format(
+              func.__name__, best * 1000, count / best))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
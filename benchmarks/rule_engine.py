@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the rule engine on synthetic rule sets and result logs, so that
+regressions show up before they reach the workers.
+
+    python benchmarks/rule_engine.py [options]
+
+Rules are jQuery QueryBuilder trees, as saved by the manager, of random AND
+and OR groups over the columns of a made up process table.  Result logs
+are in osquery's snapshot, differential (diffResults) or event format,
+for a fleet of hosts.  This reports:
+
+- rows/sec through RuleManager.handle_log_entry, and through
+  Network.process (row by row) and Network.process_batch;
+- the cost of each operator, over rules using only that operator (rules
+  that end up with identical conditions share them, as they would in
+  production);
+- the memory used by the compiled network, and to evaluate one batch.
+
+Pass --help for the options controlling the size of the rule set, the
+operators used and the format of the result logs.
+"""
+import argparse
+import datetime as dt
+import gc
+import random
+import re
+import string
+import timeit
+
+import six
+
+from doorman.extensions import RuleManager
+from doorman.plugins import AbstractAlerterPlugin
+from doorman.rules import OPERATOR_MAP, Network, RuleSnapshot, maybe_make_number
+from doorman.utils import extract_results
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+DIRECTORIES = ['/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin',
+               '/opt/app/bin', '/tmp', '/var/tmp', '/home/user/.cache']
+PROGRAMS = ['bash', 'sh', 'python', 'ruby', 'node', 'sshd', 'cron', 'nginx',
+            'postgres', 'redis-server', 'osqueryd', 'curl', 'wget', 'nc',
+            'socat', 'docker', 'containerd', 'systemd', 'kworker', 'mimikatz']
+ARGUMENTS = ['-c', '-e', '--config', '/etc/app.conf', '-p 8080', '-l',
+             'http://example.com/payload', '--daemon', '-v', '-i']
+
+STRING_COLUMNS = ('path', 'name', 'cmdline')
+NUMBER_COLUMNS = ('pid', 'uid', 'port')
+
+STRING_OPERATORS = ('equal', 'not_equal', 'begins_with', 'not_begins_with',
+                    'contains', 'not_contains', 'ends_with', 'not_ends_with',
+                    'is_empty', 'is_not_empty', 'matches_regex',
+                    'not_matches_regex')
+NUMBER_OPERATORS = ('less', 'less_or_equal', 'greater', 'greater_or_equal')
+
+OPERATORS = STRING_OPERATORS + NUMBER_OPERATORS
+assert set(OPERATORS) == set(OPERATOR_MAP)
+
+FORMATS = ('snapshot', 'diff', 'event')
+
+
+def make_columns(rng):
+    directory, program = rng.choice(DIRECTORIES), rng.choice(PROGRAMS)
+    return {
+        'path': '{0}/{1}'.format(directory, program),
+        'name': program,
+        'cmdline': ' '.join([program] + rng.sample(ARGUMENTS, rng.randrange(4))),
+        'pid': str(rng.randrange(1, 65536)),
+        'uid': str(rng.choice((0, 0, 0, 500, 501, 1000))),
+        'port': str(rng.choice((0, 22, 80, 443, 5432, 6379, 8080, 31337))),
+    }
+
+
+def make_condition(rng, operator):
+    """ Returns a QueryBuilder column condition using `operator`. """
+    if operator in ('is_empty', 'is_not_empty'):
+        value = rng.choice(STRING_COLUMNS)
+    elif operator in NUMBER_OPERATORS:
+        column = rng.choice(NUMBER_COLUMNS)
+        value = [column, make_columns(rng)[column]]
+    else:
+        columns = make_columns(rng)
+        column = rng.choice(STRING_COLUMNS)
+        sample = columns[column]
+
+        if operator.endswith('begins_with'):
+            expected = sample[:rng.randrange(1, len(sample) + 1)]
+        elif operator.endswith('ends_with'):
+            expected = sample[-rng.randrange(1, len(sample) + 1):]
+        elif operator.endswith('contains'):
+            expected = columns['name']
+        elif operator.endswith('regex'):
+            expected = '.*{0}(\\s|$)'.format(re.escape(columns['name']))
+        else:
+            expected = sample
+
+        # A numeric-looking pattern is converted to a number, which string
+        # operators can't compare with strings.
+        if not isinstance(maybe_make_number(expected), six.string_types):
+            return make_condition(rng, operator)
+        value = [column, expected]
+
+    return {
+        'id': 'column',
+        'field': 'column',
+        'type': 'string',
+        'input': 'text',
+        'operator': 'column_' + operator,
+        'value': value,
+    }
+
+
+def make_group(rng, operators, depth, width):
+    rules = []
+    for _ in range(rng.randrange(1, width + 1)):
+        if depth > 1 and rng.random() < 0.3:
+            rules.append(make_group(rng, operators, depth - 1, width))
+        else:
+            rules.append(make_condition(rng, rng.choice(operators)))
+    return {'condition': rng.choice(('AND', 'OR')), 'rules': rules}
+
+
+def make_rule(rng, operators, query_names, depth=3, width=3):
+    """
+    Returns the conditions of a rule for one of `query_names` (or, for a
+    few rules, any query) of up to `depth` nested groups, of up to `width`
+    conditions each.
+    """
+    rules = [make_group(rng, operators, depth, width)]
+    if rng.random() < 0.95:
+        rules.insert(0, {
+            'id': 'query_name',
+            'field': 'query_name',
+            'type': 'string',
+            'input': 'text',
+            'operator': 'equal',
+            'value': rng.choice(query_names),
+        })
+    if rng.random() < 0.5:
+        rules.insert(1, {
+            'id': 'action',
+            'field': 'action',
+            'type': 'string',
+            'input': 'text',
+            'operator': 'equal',
+            'value': rng.choice(('added', 'removed', 'snapshot')),
+        })
+    return {'condition': 'AND', 'rules': rules}
+
+
+def make_result_log(rng, format, query_name, rows, host_identifier):
+    """
+    Returns a result log, as posted by osquery to the logger endpoint, of
+    `rows` rows for a query, in the given format.
+    """
+    now = dt.datetime.utcnow()
+    entry = {
+        'name': query_name,
+        'hostIdentifier': host_identifier,
+        'calendarTime': '{0} UTC'.format(now.ctime()),
+        'unixTime': now.strftime('%s'),
+    }
+
+    if format == 'snapshot':
+        entry['snapshot'] = [make_columns(rng) for _ in range(rows)]
+        return {'data': [entry]}
+
+    elif format == 'diff':
+        added = rng.randrange(rows + 1)
+        entry['diffResults'] = {
+            'added': [make_columns(rng) for _ in range(added)],
+            'removed': [make_columns(rng) for _ in range(rows - added)],
+        }
+        return {'data': [entry]}
+
+    data = []
+    for _ in range(rows):
+        data.append(dict(entry, action=rng.choice(('added', 'removed')),
+                         columns=make_columns(rng)))
+    return {'data': data}
+
+
+class NullAlerter(AbstractAlerterPlugin):
+
+    def __init__(self, config):
+        self.alerts = 0
+
+    def handle_alert(self, node, match):
+        self.alerts += 1
+
+
+def make_entries(log):
+    """ Returns the rows of a result log, as the rule manager passes them. """
+    return [{'name': name, 'action': action, 'timestamp': timestamp,
+             'columns': columns}
+            for name, action, columns, timestamp in extract_results(log)]
+
+
+def make_network(rules):
+    network = Network()
+    for rule_id, conditions in enumerate(rules):
+        network.parse_query(conditions, alerters=['null'], rule_id=rule_id)
+    network.compile()
+    return network
+
+
+def make_rule_manager(network, rules):
+    manager = RuleManager()
+    manager.alerters = {'null': NullAlerter({})}
+    manager.network = network
+    manager.rules = dict(
+        (rule_id, RuleSnapshot(id=rule_id,
+                               name='rule-{0}'.format(rule_id),
+                               description=None,
+                               alerters=('null', ),
+                               template=string.Template('')))
+        for rule_id in range(len(rules)))
+
+    # the rules are not in a database, so there is nothing to reload
+    manager.load_rules = lambda: None
+    return manager
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def report(name, seconds, rows):
+    print('{0:>24}: {1:8.2f} ms, {2:10.0f} rows/sec'.format(
+          name, seconds * 1000, rows / seconds))
+
+
+def bench_throughput(args, rng, query_names):
+    rules = [make_rule(rng, args.operators, query_names, args.depth, args.width)
+             for _ in range(args.rules)]
+    network = make_network(rules)
+    manager = make_rule_manager(network, rules)
+
+    logs = [make_result_log(rng, args.format, rng.choice(query_names),
+                            args.rows, 'host-{0}'.format(i))
+            for i in range(args.batches)]
+    node = {'host_identifier': 'host-0'}
+    entries = [make_entries(log) for log in logs]
+    rows = sum(len(batch) for batch in entries)
+
+    print('throughput: {0} rules, {1} conditions, {2} batches of {3} rows '
+          '({4} format)'.format(args.rules, len(network.conditions),
+                                args.batches, args.rows, args.format))
+
+    def handle_log_entry():
+        for log in logs:
+            manager.handle_log_entry(log, node)
+
+    def process():
+        for batch in entries:
+            for entry in batch:
+                network.process(entry, node)
+
+    def process_batch():
+        for batch in entries:
+            network.process_batch(batch, node)
+
+    for func in (handle_log_entry, process, process_batch):
+        report(func.__name__, best_of(func, args.repeat), rows)
+
+
+def bench_operators(args, rng, query_names):
+    print('operators: {0} rules each, {1} rows'.format(
+          args.rules, args.rows))
+
+    rows = [{'name': query_names[0], 'action': 'added', 'timestamp': None,
+             'columns': make_columns(rng)} for _ in range(args.rows)]
+    node = {'host_identifier': 'host-0'}
+
+    for operator in args.operators:
+        rules = [{
+            'condition': 'AND',
+            'rules': [{'field': 'query_name', 'operator': 'equal',
+                       'value': query_names[0]},
+                      make_condition(rng, operator)],
+        } for _ in range(args.rules)]
+        network = make_network(rules)
+
+        seconds = best_of(lambda: network.process_batch(rows, node), args.repeat)
+        print('{0:>24}: {1:8.2f} ms, {2:8.0f} ns per row per rule'.format(
+              operator, seconds * 1000,
+              seconds * 1e9 / (len(rows) * args.rules)))
+
+
+def bench_memory(args, rng, query_names):
+    if tracemalloc is None:
+        print('memory: skipped, as tracemalloc is not available')
+        return
+
+    rules = [make_rule(rng, args.operators, query_names, args.depth, args.width)
+             for _ in range(args.rules)]
+    log = make_result_log(rng, args.format, query_names[0], args.rows, 'host-0')
+    batch = make_entries(log)
+
+    print('memory: {0} rules, one batch of {1} rows'.format(
+          args.rules, len(batch)))
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        network = make_network(rules)
+        print('{0:>24}: {1:8.1f} KiB'.format(
+              'network', (tracemalloc.get_traced_memory()[0] - before) / 1024.0))
+
+        # restart tracing, so the peak is that of evaluating the batch
+        tracemalloc.stop()
+        tracemalloc.start()
+        network.process_batch(batch, {'host_identifier': 'host-0'})
+        print('{0:>24}: {1:8.1f} KiB'.format(
+              'process_batch (peak)', tracemalloc.get_traced_memory()[1] / 1024.0))
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rules', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='rows per result log')
+    parser.add_argument('--batches', type=int, default=5,
+                        help='result logs for the throughput benchmark')
+    parser.add_argument('--queries', type=int, default=20,
+                        help='distinct query names')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='maximum nesting of condition groups')
+    parser.add_argument('--width', type=int, default=3,
+                        help='maximum conditions per group')
+    parser.add_argument('--format', choices=FORMATS, default='snapshot')
+    parser.add_argument('--operators', type=lambda v: v.split(','),
+                        default=list(OPERATORS),
+                        help='comma-separated operators to use in rules')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', choices=('throughput', 'operators', 'memory'))
+    args = parser.parse_args()
+
+    unknown = set(args.operators) - set(OPERATORS)
+    if unknown:
+        parser.error('unknown operator(s): {0}'.format(', '.join(sorted(unknown))))
+
+    query_names = ['query-{0}'.format(i) for i in range(args.queries)]
+
+    for name, bench in (('throughput', bench_throughput),
+                        ('operators', bench_operators),
+                        ('memory', bench_memory)):
+        if args.only in (None, name):
+            bench(args, random.Random(args.seed), query_names)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the compiled rule evaluation of doorman.rules.Network.process,
+and of Network.process_batch over all of the rows at once, against
+walking the condition graph with BaseCondition.run, as it was done
+before, on a synthetic rule set.
+
+    python benchmarks/rules.py [rules] [rows] [query names]
+
+Rules are spread evenly over the query names; use a single query name to
+see the effect of grouping the conditions of many rules on one column.
+"""
+import datetime as dt
+import random
+import sys
+import timeit
+
+from doorman.rules import Network, RuleInput
+
+
+def make_rule(i, queries):
+    return {
+        'condition': 'AND',
+        'rules': [
+            {'field': 'query_name', 'operator': 'equal',
+             'value': 'query-{0}'.format(i % queries)},
+            {'field': 'action', 'operator': 'equal', 'value': 'added'},
+            {
+                'condition': 'OR',
+                'rules': [
+                    {'field': 'column', 'operator': 'column_contains',
+                     'value': ['path', 'ioc-{0}'.format(i)]},
+                    {'field': 'column', 'operator': 'column_equal',
+                     'value': ['name', 'evil-{0}'.format(i)]},
+                ],
+            },
+        ],
+    }
+
+
+def make_rows(count, queries, rules):
+    now = dt.datetime.utcnow()
+    rows = []
+    for i in range(count):
+        rows.append({
+            'name': 'query-{0}'.format(random.randrange(queries)),
+            'action': random.choice(('added', 'removed')),
+            'timestamp': now,
+            'columns': {
+                'path': '/usr/local/bin/ioc-{0}'.format(random.randrange(rules * 10)),
+                'name': 'evil-{0}'.format(random.randrange(rules * 10)),
+                'pid': str(random.randrange(65536)),
+            },
+        })
+    return rows
+
+
+def legacy_process(network, entry, node):
+    input = RuleInput(result_log=entry, node=node)
+
+    for condition in network.conditions.values():
+        condition.evaluated = False
+
+    alerts = set()
+    for (alert, upstream, rule_id) in network.alert_conditions:
+        if upstream.run(input):
+            alerts.add((alert, rule_id))
+    return alerts
+
+
+def main(rules=1000, rows=1000, queries=50):
+    random.seed(0)
+
+    network = Network()
+    for i in range(rules):
+        network.parse_query(make_rule(i, queries), alerters=['debug'], rule_id=i)
+
+    entries = make_rows(rows, queries, rules)
+    node = {'host_identifier': 'foobar'}
+
+    # both must agree before we time anything
+    for entry in entries:
+        assert network.process(entry, node) == legacy_process(network, entry, node)
+    assert network.process_batch(entries, node) == \
+        [network.process(entry, node) for entry in entries]
+
+    def legacy():
+        for entry in entries:
+            legacy_process(network, entry, node)
+
+    def compiled():
+        for entry in entries:
+            network.process(entry, node)
+
+    def batch():
+        network.process_batch(entries, node)
+
+    print('{0} rules, {1} conditions, {2} rows'.format(
+          rules, len(network.conditions), rows))
+
+    for func in (legacy, compiled, batch):
+        best = min(timeit.repeat(func, number=1, repeat=3))
+        print('{0:>10}: {1:8.2f} ms, {2:10.0f} rows/sec'.format(
+              func.__name__, best * 1000, rows / best))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
@@ -1,21 +1,26 @@
 # -*- coding: utf-8 -*-
 from functools import wraps
-from io import BytesIO
 import datetime as dt
-import gzip
 import json
+import zlib
 
 from flask import Blueprint, current_app, jsonify, request, g
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
 from doorman.database import db
-from doorman.extensions import log_tee
+from doorman.extensions import (
+    ingest_buffer, log_tee, node_cache, pending_work
+)
 from doorman.models import (
     Node, Tag,
-    DistributedQueryTask, DistributedQueryResult,
+    DistributedQueryTask,
     StatusLog,
 )
 from doorman.tasks import analyze_result
-from doorman.utils import process_result
+from doorman.utils import (
+    ResultBatch, copy_result_logs, get_configuration_json, inflate_gzip,
+    process_result, update_checkin, write_distributed_query_results
+)
 
 
 blueprint = Blueprint('api', __name__)
@@ -58,12 +63,23 @@ def teardown_request(*args, **kwargs):
 def node_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        max_size = current_app.config['DOORMAN_MAX_DECOMPRESSED_SIZE']
+
         # in v1.7.4, the Content-Encoding header is set when
         # --logger_tls_compress=true
         if 'Content-Encoding' in request.headers and \
             request.headers['Content-Encoding'] == 'gzip':
-            request._cached_data = gzip.GzipFile(
-                fileobj=BytesIO(request.get_data())).read()
+            try:
+                request._cached_data = inflate_gzip(request.stream, max_size)
+            except zlib.error:
+                current_app.logger.error(
+                    "%s - Request could not be decompressed",
+                    request.remote_addr
+                )
+                return ""
+
+        elif (request.content_length or 0) > max_size:
+            raise RequestEntityTooLarge()
 
         request_json = request.get_json()
 
@@ -78,14 +94,19 @@ def node_required(f):
             return ""
 
         node_key = request_json.get('node_key')
-        node = Node.query.filter_by(node_key=node_key).first()
+        node = node_cache.get(node_key)
 
-        if not node:
-            current_app.logger.error(
-                "%s - Could not find node with node_key %s",
-                request.remote_addr, node_key
-            )
-            return jsonify(node_invalid=True)
+        if node is None:
+            node = Node.query.filter_by(node_key=node_key).first()
+
+            if not node:
+                current_app.logger.error(
+                    "%s - Could not find node with node_key %s",
+                    request.remote_addr, node_key
+                )
+                return jsonify(node_invalid=True)
+
+            node = node_cache.set(node.to_record())
 
         if not node.is_active:
             current_app.logger.error(
@@ -94,10 +115,9 @@ def node_required(f):
             )
             return jsonify(node_invalid=True)
 
-        node.update(
+        node = node._replace(
             last_checkin=dt.datetime.utcnow(),
             last_ip=request.remote_addr,
-            commit=False
         )
 
         return f(node=node, *args, **kwargs)
@@ -164,6 +184,7 @@ def enroll():
                 request.remote_addr, node, host_identifier
             )
             node.host_identifier = host_identifier
+            node_cache.invalidate(node.node_key)
 
         node.update(
             last_checkin=dt.datetime.utcnow(),
@@ -203,6 +224,7 @@ def enroll():
                     last_checkin=now,
                     enrolled_on=now,
                     last_ip=request.remote_addr)
+        node_cache.invalidate(node.node_key)
     else:
         node = Node(host_identifier=host_identifier,
                     last_checkin=now,
@@ -238,12 +260,24 @@ def configuration(node=None):
         "%s - %s checking in to retrieve a new configuration",
         request.remote_addr, node
     )
-    config = node.get_config()
+    config, etag = get_configuration_json(node)
 
     # write last_checkin, last_ip
-    db.session.add(node)
+    update_checkin(node)
     db.session.commit()
-    return jsonify(config, node_invalid=False)
+
+    if request.if_none_match.contains(etag):
+        if current_app.config['GRAPHITE_ENABLED']:
+            metrics = current_app.metrics[request.endpoint]
+            metrics.not_modified.mark()
+            metrics.not_modified_bytes.mark(len(config))
+
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(config, mimetype='application/json')
+
+    response.set_etag(etag)
+    return response
 
 
 @blueprint.route('/log', methods=['POST', 'PUT'])
@@ -260,22 +294,42 @@ def logger(node=None):
         current_app.logger.debug(json.dumps(data, indent=2))
 
     if log_type == 'status':
+        # validate the logs here, rather than failing to write them later
+        # along with those of other nodes
+        try:
+            status_logs = [item for item in data.get('data', [])
+                           if int(item['severity']) >= log_level]
+            rows = [StatusLog(node_id=node.id, **item) for item in status_logs]
+        except (KeyError, TypeError, ValueError):
+            raise_invalid_log(log_type, node)
+
         log_tee.handle_status(data, host_identifier=node.host_identifier)
-        for item in data.get('data', []):
-            if int(item['severity']) < log_level:
-                continue
-            status_log = StatusLog(node=node, **item)
-            db.session.add(status_log)
-        else:
-            db.session.add(node)
-            db.session.commit()
+
+        if not ingest_buffer.put('status', node, status_logs):
+            for status_log in rows:
+                db.session.add(status_log)
+            else:
+                update_checkin(node)
+                db.session.commit()
 
     elif log_type == 'result':
-        db.session.add(node)
-        db.session.bulk_save_objects(process_result(data, node))
-        db.session.commit()
+        # normalize the results once, for the database, log plugins and
+        # rule analysis to share
+        data = ResultBatch(data)
+        try:
+            data.validate()
+        except ValueError:
+            raise_invalid_log(log_type, node)
+
+        if not ingest_buffer.put('result', node, data):
+            update_checkin(node)
+            if current_app.config['DOORMAN_RESULT_LOG_INGESTION'] == 'copy':
+                copy_result_logs(data, node)
+            else:
+                db.session.bulk_save_objects(process_result(data, node))
+            db.session.commit()
         log_tee.handle_result(data, host_identifier=node.host_identifier)
-        analyze_result.delay(data, node.to_dict())
+        analyze_result.delay(data.rows(), node.to_dict())
 
     else:
         current_app.logger.error("%s - Unknown log_type %r",
@@ -283,12 +337,18 @@ def logger(node=None):
         )
         current_app.logger.info(json.dumps(data))
         # still need to write last_checkin, last_ip
-        db.session.add(node)
+        update_checkin(node)
         db.session.commit()
 
     return jsonify(node_invalid=False)
 
 
+def raise_invalid_log(log_type, node):
+    current_app.logger.exception("%s - Invalid %s log from %s",
+                                 request.remote_addr, log_type, node)
+    raise BadRequest()
+
+
 @blueprint.route('/distributed/read', methods=['POST', 'PUT'])
 @blueprint.route('/v1/distributed/read', methods=['POST', 'PUT'])
 @node_required
@@ -302,11 +362,26 @@ def distributed_read(node=None):
         request.remote_addr, node
     )
 
-    queries = node.get_new_queries()
+    queries = {}
+
+    if pending_work.has_work(node.id):
+        # clear the marker before claiming tasks, so that work added
+        # concurrently is marked again rather than lost
+        pending_work.clear(node.id)
+        queries = node.get_new_queries()
+
+        # tasks that are not yet due remain NEW
+        if pending_work.enabled and db.session.query(
+            DistributedQueryTask.id
+        ).filter(
+            DistributedQueryTask.node_id == node.id,
+            DistributedQueryTask.status == DistributedQueryTask.NEW,
+        ).first():
+            pending_work.mark(node.id)
 
     # need to write last_checkin, last_ip, and update distributed
     # query state
-    db.session.add(node)
+    update_checkin(node)
     db.session.commit()
 
     return jsonify(queries=queries, node_invalid=False)
@@ -323,14 +398,27 @@ def distributed_write(node=None):
     if current_app.debug:
         current_app.logger.debug(json.dumps(data, indent=2))
 
-    for guid, results in data.get('queries', {}).items():
-        task = DistributedQueryTask.query.filter(
-            DistributedQueryTask.guid == guid,
+    queries = data.get('queries', {})
+
+    # resolve every guid in one query, rather than one query per guid
+    tasks = {}
+    if queries:
+        for guid, task_id, distributed_query_id in db.session.query(
+            DistributedQueryTask.guid,
+            DistributedQueryTask.id,
+            DistributedQueryTask.distributed_query_id,
+        ).filter(
+            DistributedQueryTask.guid.in_(list(queries)),
             DistributedQueryTask.status == DistributedQueryTask.PENDING,
-            DistributedQueryTask.node == node,
-        ).first()
+            DistributedQueryTask.node_id == node.id,
+        ):
+            tasks[guid] = (task_id, distributed_query_id)
 
-        if not task:
+    now = dt.datetime.utcnow()
+    rows = []
+
+    for guid, results in queries.items():
+        if guid not in tasks:
             current_app.logger.error(
                 "%s - Got result for distributed query not in PENDING "
                 "state: %s: %s",
@@ -338,20 +426,21 @@ def distributed_write(node=None):
             )
             continue
 
+        task_id, distributed_query_id = tasks[guid]
         for columns in results:
-            result = DistributedQueryResult(
-                columns,
-                distributed_query=task.distributed_query,
-                distributed_query_task=task
-            )
-            db.session.add(result)
-        else:
-            task.status = DistributedQueryTask.COMPLETE
-            db.session.add(task)
+            rows.append((columns, now, task_id, distributed_query_id))
 
-    else:
-        # need to write last_checkin, last_ip on node
-        db.session.add(node)
-        db.session.commit()
+    write_distributed_query_results(rows)
+
+    if tasks:
+        DistributedQueryTask.query.filter(
+            DistributedQueryTask.id.in_([task_id for task_id, _ in tasks.values()]),
+        ).update({
+            'status': DistributedQueryTask.COMPLETE,
+        }, synchronize_session=False)
+
+    # need to write last_checkin, last_ip on node
+    update_checkin(node)
+    db.session.commit()
 
     return jsonify(node_invalid=False)
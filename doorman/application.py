@@ -7,12 +7,15 @@ from doorman.api import blueprint as api
 from doorman.assets import assets
 from doorman.manage import blueprint as backend
 from doorman.extensions import (
-    bcrypt, csrf, db, debug_toolbar, ldap_manager, log_tee, login_manager,
-    mail, make_celery, metrics, migrate, rule_manager, sentry
+    alert_throttle, bcrypt, checkin_coalescer, config_cache, csrf, db, debug_toolbar,
+    ingest_buffer, ldap_manager, log_tee, login_manager, mail, make_celery,
+    metrics, migrate, node_cache, pending_work, rule_manager, sentry
 )
 from doorman.settings import ProdConfig
 from doorman.tasks import celery
-from doorman.utils import get_node_health, pretty_field, pretty_operator
+from doorman.utils import (
+    get_last_checkin, get_node_health, pretty_field, pretty_operator
+)
 
 
 def create_app(config=ProdConfig):
@@ -52,6 +55,12 @@ def register_extensions(app):
     assets.init_app(app)
     debug_toolbar.init_app(app)
     log_tee.init_app(app)
+    ingest_buffer.init_app(app)
+    node_cache.init_app(app)
+    checkin_coalescer.init_app(app)
+    config_cache.init_app(app)
+    pending_work.init_app(app)
+    alert_throttle.init_app(app)
     rule_manager.init_app(app)
     mail.init_app(app)
     make_celery(app, celery)
@@ -106,6 +115,7 @@ def register_errorhandlers(app):
 
 def register_filters(app):
     app.jinja_env.filters['health'] = get_node_health
+    app.jinja_env.filters['last_checkin'] = get_last_checkin
     app.jinja_env.filters['pretty_field'] = pretty_field
     app.jinja_env.filters['pretty_operator'] = pretty_operator
 
@@ -1,4 +1,14 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict, namedtuple
+from functools import partial
+import atexit
+import hashlib
+import json
+import threading
+import time
+
+from six.moves.queue import Empty, Full, Queue
+
 from flask_bcrypt import Bcrypt
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_ldap3_login import LDAP3LoginManager
@@ -48,16 +58,718 @@ class LogTee(object):
             plugin.handle_result(data, **kwargs)
 
 
+PendingLog = namedtuple('PendingLog', ['log_type', 'node_id', 'data',
+                                       'last_checkin', 'last_ip'])
+
+
+class IngestBuffer(object):
+    """
+    An optional, in-process write-behind buffer for the /log endpoint.
+
+    Requests enqueue their parsed payload and return immediately, while a
+    background thread drains the queue and writes payloads from many nodes
+    in a single transaction. Payloads should be validated before they are
+    enqueued; should a batch fail nonetheless, its payloads are written one
+    at a time. The queue is bounded; when it stays full for
+    DOORMAN_INGEST_BUFFER_PUT_TIMEOUT seconds, `put` gives up and the caller
+    is expected to write synchronously, which pushes back on clients. Any
+    buffered payloads are flushed when the process exits.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.enabled = False
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        atexit.register(self.stop)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('DOORMAN_INGEST_BUFFER_ENABLED', False)
+        self.max_size = app.config.setdefault('DOORMAN_INGEST_BUFFER_MAX_SIZE', 10000)
+        self.batch_size = app.config.setdefault('DOORMAN_INGEST_BUFFER_BATCH_SIZE', 500)
+        self.flush_interval = app.config.setdefault('DOORMAN_INGEST_BUFFER_FLUSH_INTERVAL', 1.0)
+        self.put_timeout = app.config.setdefault('DOORMAN_INGEST_BUFFER_PUT_TIMEOUT', 5.0)
+
+    def start(self):
+        # The flusher thread is started lazily, on the first payload, so
+        # that it is created in the process that serves requests rather
+        # than in a parent process that later forks.
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.queue = Queue(maxsize=self.max_size)
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run,
+                                           name='doorman-ingest-buffer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the flusher thread, flushing anything left in the queue. """
+        with self.lock:
+            thread, self.thread = self.thread, None
+
+        if thread is None:
+            return
+
+        self.stopping.set()
+        thread.join(timeout)
+
+    def put(self, log_type, node, data):
+        """
+        Enqueue a payload for `node`. Returns False if the buffer is
+        disabled or full, in which case the caller should write the payload
+        itself.
+        """
+        if not self.enabled or self.stopping.is_set():
+            return False
+
+        if self.thread is None:
+            self.start()
+
+        pending = PendingLog(log_type=log_type,
+                             node_id=node.id,
+                             data=data,
+                             last_checkin=node.last_checkin,
+                             last_ip=node.last_ip)
+        try:
+            self.queue.put(pending, timeout=self.put_timeout)
+        except Full:
+            self.app.logger.warning("Ingest buffer is full, writing %s log "
+                                    "for node %s synchronously",
+                                    log_type, node.id)
+            return False
+
+        return True
+
+    def run(self):
+        while not self.stopping.is_set():
+            batch = self.drain(timeout=self.flush_interval)
+            if batch:
+                self.flush(batch)
+
+        # Flush whatever is left before we go away.
+        while True:
+            batch = self.drain()
+            if not batch:
+                break
+            self.flush(batch)
+
+    def drain(self, timeout=None):
+        batch = []
+        try:
+            if timeout is None:
+                batch.append(self.queue.get_nowait())
+            else:
+                batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def flush(self, batch):
+        """
+        Write a batch of pending payloads in a single transaction or, if
+        that fails, each payload in its own, so that a bad payload only
+        loses itself rather than the logs of every node in the batch.
+        """
+        from doorman.database import db
+
+        with self.app.app_context():
+            try:
+                if self.write(batch) or len(batch) == 1:
+                    return
+
+                for pending in batch:
+                    self.write([pending])
+            finally:
+                db.session.remove()
+
+    def write(self, batch):
+        from doorman.database import db
+        from doorman.utils import write_pending_logs
+
+        try:
+            write_pending_logs(batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception("Could not flush %d buffered log(s)",
+                                      len(batch))
+            return False
+
+        return True
+
+
+class CheckinCoalescer(object):
+    """
+    Coalesces node check-ins (last_checkin and last_ip) in memory, rather
+    than rewriting the node row on every osquery request. A background
+    thread writes the latest check-in of every node that has been seen
+    every DOORMAN_CHECKIN_COALESCE_INTERVAL seconds, as a handful of
+    batched UPDATE statements. Pending check-ins are flushed when the
+    process exits.
+
+    Until they are flushed, coalesced check-ins are only visible to the
+    process that recorded them (see `get`); other processes, such as the
+    manager's node lists, see the last_checkin in the database, which can
+    be up to an interval behind.
+
+    An interval of 0 disables coalescing, and check-ins are written as
+    part of each request instead.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.interval = 0
+        self.pending = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        atexit.register(self.stop)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.setdefault('DOORMAN_CHECKIN_COALESCE_INTERVAL', 0)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run,
+                                           name='doorman-checkin-coalescer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the flusher thread, writing any pending check-ins. """
+        with self.lock:
+            thread, self.thread = self.thread, None
+
+        if thread is None:
+            return
+
+        self.stopping.set()
+        thread.join(timeout)
+
+    def record(self, node):
+        """
+        Remember the check-in of `node`. Returns False if coalescing is
+        disabled, in which case the caller should write the check-in itself.
+        """
+        if not self.interval or self.stopping.is_set():
+            return False
+
+        if self.thread is None:
+            self.start()
+
+        with self.lock:
+            self.pending[node.id] = (node.last_checkin, node.last_ip)
+
+        return True
+
+    def get(self, node_id):
+        """ Returns the pending (last_checkin, last_ip) of a node, if any. """
+        with self.lock:
+            return self.pending.get(node_id)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+
+        self.flush()
+
+    def flush(self):
+        from doorman.database import db
+        from doorman.utils import write_checkins
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        with self.app.app_context():
+            try:
+                write_checkins(pending)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Could not write %d check-in(s)",
+                                          len(pending))
+
+                # hold on to these for the next attempt, unless they've
+                # since been superseded by a newer check-in
+                with self.lock:
+                    for node_id, checkin in pending.items():
+                        self.pending.setdefault(node_id, checkin)
+            finally:
+                db.session.remove()
+
+
+class ConfigCache(object):
+    """
+    An LRU cache of ready-to-send osquery configurations, as JSON, keyed by
+    the set of tags a node has. Every entry belongs to a configuration
+    generation, which is bumped whenever a pack, query, file path or tag
+    changes (see models.configuration_changed); an entry from an older
+    generation is never served.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.enabled = False
+        self.generation = None
+        self.configs = OrderedDict()
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('DOORMAN_CONFIG_CACHE_ENABLED', False)
+        self.max_size = app.config.setdefault('DOORMAN_CONFIG_CACHE_MAX_SIZE', 1000)
+        self.invalidate()
+
+    def get(self, tags, generation):
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            if generation != self.generation:
+                return None
+
+            config = self.configs.pop(tags, None)
+            if config is not None:
+                # re-insert to mark this entry as the most recently used
+                self.configs[tags] = config
+            return config
+
+    def set(self, tags, generation, config):
+        if not self.enabled:
+            return config
+
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.configs.clear()
+                self.generation = generation
+            elif generation < self.generation:
+                return config
+
+            self.configs[tags] = config
+
+            while len(self.configs) > self.max_size:
+                self.configs.popitem(last=False)
+
+        return config
+
+    def invalidate(self):
+        with self.lock:
+            self.generation = None
+            self.configs.clear()
+
+
+class NodeCache(object):
+    """
+    A TTL/LRU cache from node_key to NodeRecord, allowing the osquery API
+    endpoints to authenticate a node without querying the database.
+
+    Entries are invalidated by the manager when a node is (de)activated or
+    re-tagged. Other processes, such as a standalone API deployment, only
+    see such changes once DOORMAN_NODE_CACHE_TTL seconds have passed.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.enabled = False
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('DOORMAN_NODE_CACHE_ENABLED', False)
+        self.ttl = app.config.setdefault('DOORMAN_NODE_CACHE_TTL', 60)
+        self.max_size = app.config.setdefault('DOORMAN_NODE_CACHE_MAX_SIZE', 50000)
+        self.invalidate()
+
+    def get(self, node_key):
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.records.pop(node_key, None)
+            if entry is None:
+                return None
+
+            expires, record = entry
+            if expires < time.time():
+                return None
+
+            # re-insert to mark this entry as the most recently used
+            self.records[node_key] = entry
+            return record
+
+    def set(self, record):
+        if not self.enabled:
+            return record
+
+        with self.lock:
+            self.records.pop(record.node_key, None)
+            self.records[record.node_key] = (time.time() + self.ttl, record)
+
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+        return record
+
+    def invalidate(self, node_key=None):
+        """ Drop a single node_key from the cache, or everything. """
+        with self.lock:
+            if node_key is None:
+                self.records.clear()
+            else:
+                self.records.pop(node_key, None)
+
+
+class MemoryPendingWorkStore(object):
+    """
+    Keeps the ids of nodes with pending work in a set in this process. This
+    is only suitable when the manager and the osquery API are served by the
+    same process; otherwise, new work is only seen once the store re-syncs.
+    """
+    errors = ()
+
+    def __init__(self, sync_interval):
+        self.sync_interval = sync_interval
+        self.node_ids = set()
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def add(self, *node_ids):
+        with self.lock:
+            self.node_ids.update(node_ids)
+
+    def discard(self, node_id):
+        with self.lock:
+            self.node_ids.discard(node_id)
+
+    def __contains__(self, node_id):
+        return node_id in self.node_ids
+
+    def is_synced(self):
+        return self.synced_at is not None and \
+            time.time() - self.synced_at < self.sync_interval
+
+    def set_synced(self):
+        self.synced_at = time.time()
+
+
+class RedisPendingWorkStore(object):
+    """
+    Keeps the ids of nodes with pending work in a Redis set, shared by
+    every process.
+    """
+    def __init__(self, url, key, sync_interval):
+        import redis
+
+        self.errors = (redis.RedisError, )
+        self.redis = redis.StrictRedis.from_url(url, socket_timeout=1)
+        self.key = key
+        self.sync_interval = sync_interval
+
+    def add(self, *node_ids):
+        self.redis.sadd(self.key, *node_ids)
+
+    def discard(self, node_id):
+        self.redis.srem(self.key, node_id)
+
+    def __contains__(self, node_id):
+        return self.redis.sismember(self.key, node_id)
+
+    def is_synced(self):
+        return self.redis.exists(self.key + ':synced')
+
+    def set_synced(self):
+        self.redis.set(self.key + ':synced', 1, ex=self.sync_interval)
+
+
+class PendingWork(object):
+    """
+    Remembers which nodes have distributed query tasks waiting for them,
+    so that a distributed read from a node with nothing to do need not
+    query the database.
+
+    Markers are only ever a hint. A node is assumed to have work whenever
+    the store cannot be reached, and the store adds every node with NEW
+    tasks in the database to its markers every
+    DOORMAN_PENDING_WORK_SYNC_INTERVAL seconds, so work marked while the
+    store was unavailable is picked up eventually.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.store = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+        backend = app.config.setdefault('DOORMAN_PENDING_WORK_BACKEND', None)
+        sync_interval = app.config.setdefault('DOORMAN_PENDING_WORK_SYNC_INTERVAL', 300)
+
+        if backend == 'memory':
+            self.store = MemoryPendingWorkStore(sync_interval)
+        elif backend == 'redis':
+            self.store = RedisPendingWorkStore(
+                app.config.setdefault('DOORMAN_PENDING_WORK_REDIS_URL',
+                                      'redis://localhost:6379/0'),
+                app.config.setdefault('DOORMAN_PENDING_WORK_REDIS_KEY',
+                                      'doorman:pending_work'),
+                sync_interval,
+            )
+        elif backend is not None:
+            raise ValueError('Unknown pending work backend: "{0}"'.format(backend))
+        else:
+            self.store = None
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def mark(self, *node_ids):
+        """ Note that these nodes have new distributed query tasks. """
+        if self.store is None or not node_ids:
+            return
+
+        try:
+            self.store.add(*node_ids)
+        except self.store.errors:
+            self.app.logger.exception("Could not mark pending work")
+
+    def clear(self, node_id):
+        if self.store is None:
+            return
+
+        try:
+            self.store.discard(node_id)
+        except self.store.errors:
+            self.app.logger.exception("Could not clear pending work")
+
+    def has_work(self, node_id):
+        """
+        Returns False only if the node is known to have no distributed
+        query tasks waiting for it.
+        """
+        if self.store is None:
+            return True
+
+        try:
+            if not self.store.is_synced():
+                self.sync()
+            return bool(node_id in self.store)
+        except self.store.errors:
+            self.app.logger.exception("Could not check for pending work")
+            return True
+
+    def sync(self):
+        """
+        Mark every node that has NEW tasks in the database. Existing markers
+        are left in place, so as not to lose any set concurrently; a stale
+        marker only costs its node one database query.
+        """
+        from doorman.database import db
+        from doorman.models import DistributedQueryTask
+
+        node_ids = [node_id for node_id, in db.session.query(
+            DistributedQueryTask.node_id.distinct()
+        ).filter(DistributedQueryTask.status == DistributedQueryTask.NEW)]
+
+        if node_ids:
+            self.store.add(*node_ids)
+        self.store.set_synced()
+
+
+class MemoryAlertThrottleStore(object):
+    """
+    Keeps throttled alert keys in an LRU in this process, so alerts are
+    only throttled per process.
+    """
+    errors = ()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.windows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, key, window):
+        now = time.time()
+
+        with self.lock:
+            entry = self.windows.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # re-insert to mark this entry as the most recently used
+                entry[1] += 1
+                self.windows[key] = entry
+                return None
+
+            self.windows[key] = [now + window, 0]
+            while len(self.windows) > self.max_size:
+                self.windows.popitem(last=False)
+
+        return entry[1] if entry is not None else 0
+
+
+class RedisAlertThrottleStore(object):
+    """
+    Keeps throttled alert keys in Redis, shared by every process. The count
+    of suppressed alerts for a key is forgotten a day after the last one.
+    """
+    COUNT_TTL = 24 * 60 * 60
+
+    def __init__(self, url, prefix):
+        import redis
+
+        self.errors = (redis.RedisError, )
+        self.redis = redis.StrictRedis.from_url(url, socket_timeout=1)
+        self.prefix = prefix
+
+    def check(self, key, window):
+        key = self.prefix + hashlib.sha1(key).hexdigest()
+        count_key = key + ':suppressed'
+
+        if not self.redis.set(key, 1, ex=window, nx=True):
+            pipe = self.redis.pipeline()
+            pipe.incr(count_key)
+            pipe.expire(count_key, self.COUNT_TTL)
+            pipe.execute()
+            return None
+
+        pipe = self.redis.pipeline()
+        pipe.get(count_key)
+        pipe.delete(count_key)
+        suppressed, _ = pipe.execute()
+        return int(suppressed or 0)
+
+
+class AlertThrottle(object):
+    """
+    Suppresses repeated alerts, so that a noisy rule doesn't deliver an
+    alert for every matching row. Once an alert has been delivered for a
+    rule, node and, optionally, the values of some of the result's columns,
+    alerts with the same key are suppressed for the next
+    DOORMAN_ALERT_THROTTLE_WINDOW seconds. How many were suppressed is
+    passed on with the next alert delivered for that key.
+
+    Throttling is only ever best-effort: if the store cannot be reached,
+    every alert is delivered.
+    """
+    def __init__(self, app=None):
+        self.app = app
+        self.store = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+        backend = app.config.setdefault('DOORMAN_ALERT_THROTTLE_BACKEND', None)
+        self.window = app.config.setdefault('DOORMAN_ALERT_THROTTLE_WINDOW', 300)
+        self.key_columns = app.config.setdefault('DOORMAN_ALERT_THROTTLE_KEY_COLUMNS', {})
+
+        if backend == 'memory':
+            self.store = MemoryAlertThrottleStore(
+                app.config.setdefault('DOORMAN_ALERT_THROTTLE_MAX_SIZE', 100000))
+        elif backend == 'redis':
+            self.store = RedisAlertThrottleStore(
+                app.config.setdefault('DOORMAN_ALERT_THROTTLE_REDIS_URL',
+                                      'redis://localhost:6379/0'),
+                app.config.setdefault('DOORMAN_ALERT_THROTTLE_REDIS_PREFIX',
+                                      'doorman:alert_throttle:'),
+            )
+        elif backend is not None:
+            raise ValueError('Unknown alert throttle backend: "{0}"'.format(backend))
+        else:
+            self.store = None
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def make_key(self, rule, node, result):
+        columns = self.key_columns.get(rule.name, ())
+        return json.dumps([
+            rule.id,
+            node['host_identifier'],
+            [result['columns'].get(column) for column in columns],
+        ]).encode('utf-8')
+
+    def check(self, rule, node, result):
+        """
+        Returns None if an alert for this rule, node and result should be
+        suppressed, or else the number of alerts with the same key that
+        were suppressed since the last one delivered.
+        """
+        if self.store is None:
+            return 0
+
+        try:
+            return self.store.check(self.make_key(rule, node, result), self.window)
+        except self.store.errors:
+            self.app.logger.exception("Could not check the alert throttle")
+            return 0
+
+
 class RuleManager(object):
+    """
+    Evaluates result logs against the rules, and triggers their alerters.
+
+    Rules are reloaded when the rules generation, bumped whenever a rule is
+    added, changed or deleted through the ORM (see models.rule_changed),
+    has changed since they were last loaded.
+    That is checked at most every DOORMAN_RULES_RELOAD_INTERVAL seconds.
+
+    Repeated alerts are suppressed by the alert throttle, if enabled. If
+    DOORMAN_ALERT_DISPATCH_ENABLED is set, alerts are queued for the
+    dispatch_alert task, rather than delivered while handling the results.
+    """
     def __init__(self, app=None):
         self.network = None
-        self.last_update = None
+        self.rules = {}
+        self.generation = None
+        self.checked_at = None
+        self.reload_interval = 0
+        self.dispatch_enabled = False
 
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
         self.app = app
+        self.reload_interval = app.config.setdefault('DOORMAN_RULES_RELOAD_INTERVAL', 10)
+        self.dispatch_enabled = app.config.setdefault('DOORMAN_ALERT_DISPATCH_ENABLED', False)
+        self.queue_prefix = app.config.setdefault('DOORMAN_ALERT_QUEUE_PREFIX', 'alerts.')
+        self.time_limit = app.config.setdefault('DOORMAN_ALERT_TIME_LIMIT', 60)
+        app.config.setdefault('DOORMAN_ALERT_MAX_RETRIES', 5)
+        app.config.setdefault('DOORMAN_ALERT_RETRY_BACKOFF', 30)
+        self.network = None
+        self.rules = {}
+        self.generation = None
+        self.checked_at = None
         self.load_alerters()
 
         # Save this instance on the app, so we have a way to get at it.
@@ -82,35 +794,48 @@ class RuleManager(object):
             if not issubclass(klass, AbstractAlerterPlugin):
                 raise ValueError('{0} is not a subclass of AbstractAlerterPlugin'.format(name))
 
-            self.alerters[name] = klass(config)
+            alerter = self.alerters[name] = klass(config)
+
+            # Have digests the alerter fails to send retried by a task.
+            digest = getattr(alerter, 'digest', None)
+            if digest is not None:
+                digest.requeue = partial(self.queue_digest, name)
 
     def should_reload_rules(self):
         """ Checks if we need to reload the set of rules. """
-        from doorman.models import Rule
+        from doorman.utils import RULES_GENERATION, get_generation
 
-        if self.last_update is None:
+        if self.generation is None:
             return True
 
-        newest_rule = Rule.query.order_by(Rule.updated_at.desc()).limit(1).first()
-        if newest_rule and self.last_update < newest_rule.updated_at:
-            return True
+        now = time.time()
+        if self.checked_at is not None and \
+                now - self.checked_at < self.reload_interval:
+            return False
 
-        return False
+        self.checked_at = now
+        return get_generation(RULES_GENERATION) != self.generation
 
-    def load_rules(self):
-        """ Load rules from the database. """
-        from doorman.rules import Network
+    def load_rules(self, force=False):
+        """
+        Load rules from the database, if they have changed, or regardless
+        if `force` is set.
+        """
+        from doorman.rules import Network, RuleSnapshot
         from doorman.models import Rule
+        from doorman.utils import RULES_GENERATION, get_generation
 
-        if not self.should_reload_rules():
+        if not force and not self.should_reload_rules():
             return
 
+        # Note: we read the generation before the rules, and not after, so
+        # that a rule changed in between the two is reloaded next time,
+        # rather than accidentally never.
+        generation = get_generation(RULES_GENERATION)
         all_rules = list(Rule.query.all())
 
-        self.network = Network()
-
-        if not all_rules:
-            return
+        network = Network()
+        rules = {}
 
         for rule in all_rules:
             # Verify the alerters
@@ -119,49 +844,99 @@ class RuleManager(object):
                     raise ValueError('No such alerter: "{0}"'.format(alerter))
 
             # Create the rule.
-            self.network.parse_query(rule.conditions, alerters=rule.alerters, rule_id=rule.id)
+            network.parse_query(rule.conditions, alerters=rule.alerters, rule_id=rule.id)
+
+            # Keep a copy of the rule to hand to alerters when it matches.
+            rules[rule.id] = RuleSnapshot(
+                id=rule.id,
+                name=rule.name,
+                description=rule.description,
+                alerters=tuple(rule.alerters),
+                template=rule.template,
+            )
 
-        # Save the last updated date
-        # Note: we do this here, and not in should_reload_rules, because it's
-        # possible that we've reloaded a rule in between the two functions, and
-        # thus we accidentally don't reload when we should.
-        self.last_update = max(r.updated_at for r in all_rules)
+        self.network = network
+        self.rules = rules
+
+        self.generation = generation
+        self.checked_at = time.time()
 
     def handle_log_entry(self, entry, node):
         """ The actual entrypoint for handling input log entries. """
-        from doorman.models import Rule
         from doorman.rules import RuleMatch
         from doorman.utils import extract_results
 
         self.load_rules()
 
+        results = [{
+            'name': name,
+            'action': action,
+            'timestamp': timestamp,
+            'columns': columns,
+        } for name, action, columns, timestamp in extract_results(entry)]
+
+        # Evaluate the rules over the whole batch of results at once.
         to_trigger = []
-        for name, action, columns, timestamp in extract_results(entry):
-            result = {
-                'name': name,
-                'action': action,
-                'timestamp': timestamp,
-                'columns': columns,
-            }
-            alerts = self.network.process(result, node)
+        for result, alerts in zip(results, self.network.process_batch(results, node)):
             if len(alerts) == 0:
                 continue
 
             # Alerts is a set of (alerter name, rule id) tuples.  We convert
             # these into RuleMatch instances, which is what our alerters are
-            # actually expecting.
+            # actually expecting.  Every alerter of a rule is throttled
+            # together, so a match is only checked once per rule.
+            suppressed = {}
             for alerter, rule_id in alerts:
-                rule = Rule.get_by_id(rule_id)
+                rule = self.rules[rule_id]
+                if rule_id not in suppressed:
+                    suppressed[rule_id] = alert_throttle.check(rule, node, result)
+                if suppressed[rule_id] is None:
+                    continue
 
                 to_trigger.append((alerter, RuleMatch(
                     rule=rule,
                     result=result,
-                    node=node
+                    node=node,
+                    suppressed=suppressed[rule_id],
                 )))
 
         # Now that we've collected all results, start triggering them.
         for alerter, match in to_trigger:
+            self.trigger(alerter, node, match)
+
+    def trigger(self, alerter, node, match):
+        """ Deliver an alert, or queue it for delivery if dispatch is enabled. """
+        from doorman.tasks import dispatch_alert
+        from doorman.utils import dump_match_result
+
+        if not self.dispatch_enabled:
             self.alerters[alerter].handle_alert(node, match)
+            return
+
+        # The rule is looked up again by the dispatching worker, from its
+        # own rule snapshots, as they can't be serialized.
+        dispatch_alert.apply_async(
+            (alerter, node, match.rule.id, dump_match_result(match.result),
+             match.suppressed),
+            queue=self.queue_prefix + alerter,
+            soft_time_limit=self.time_limit,
+        )
+
+    def queue_digest(self, alerter, matches):
+        """ Queue a digest that an alerter failed to send, to be retried. """
+        from doorman.tasks import dispatch_digest
+        from doorman.utils import dump_match_result
+
+        options = {'soft_time_limit': self.time_limit}
+        if self.dispatch_enabled:
+            options['queue'] = self.queue_prefix + alerter
+
+        dispatch_digest.apply_async(
+            (alerter, matches[0][1].rule.id,
+             [(node, dump_match_result(match.result), match.suppressed)
+              for node, match in matches]),
+            **options
+        )
 
 
 def make_celery(app, celery):
@@ -228,11 +1003,16 @@ class Metrics(object):
 
         app.metrics = {}
         for rule in app.url_map.iter_rules():
+            stats = [MeterStat('count'), scales.PmfStat('latency')]
+
+            # configuration bodies not sent, because the client already
+            # had the current version
+            if rule.endpoint == 'api.configuration':
+                stats.extend([MeterStat('not_modified'),
+                              MeterStat('not_modified_bytes')])
+
             app.metrics[rule.endpoint] = scales.collection(
-                rule.endpoint,
-                MeterStat('count'),
-                scales.PmfStat('latency'),
-            )
+                rule.endpoint, *stats)
 
         app.graphite = GraphitePeriodicPusher(
             host, port, period=period, prefix=prefix,
@@ -248,6 +1028,9 @@ class Metrics(object):
 bcrypt = Bcrypt()
 csrf = CsrfProtect()
 db = SQLAlchemy()
+checkin_coalescer = CheckinCoalescer()
+config_cache = ConfigCache()
+ingest_buffer = IngestBuffer()
 mail = Mail()
 migrate = Migrate()
 debug_toolbar = DebugToolbarExtension()
@@ -255,5 +1038,8 @@ log_tee = LogTee()
 ldap_manager = LDAP3LoginManager()
 login_manager = LoginManager()
 metrics = Metrics()
+node_cache = NodeCache()
+pending_work = PendingWork()
 rule_manager = RuleManager()
+alert_throttle = AlertThrottle()
 sentry = Sentry()
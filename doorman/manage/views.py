@@ -28,12 +28,14 @@ from .forms import (
     UpdateNodeForm,
 )
 from doorman.database import db
+from doorman.extensions import node_cache, pending_work
 from doorman.models import (
     DistributedQuery, DistributedQueryTask, DistributedQueryResult,
     FilePath, Node, Pack, Query, Tag, Rule, StatusLog
 )
 from doorman.utils import (
-    create_query_pack_from_upload, flash_errors, get_paginate_options
+    create_distributed_query_tasks, create_query_pack_from_upload,
+    flash_errors, get_last_checkin, get_paginate_options
 )
 
 
@@ -123,7 +125,7 @@ def nodes_csv():
             node.display_name,
             node.host_identifier,
             node.enrolled_on,
-            node.last_checkin,
+            get_last_checkin(node),
             node.last_ip,
             node.is_active,
         ]
@@ -176,6 +178,7 @@ def get_node(node_id):
         node.node_info = node_info
         node.is_active = form.is_active.data
         node.save()
+        node_cache.invalidate(node.node_key)
 
         if request.is_xhr:
             return '', 204
@@ -231,6 +234,7 @@ def tag_node(node_id):
     if request.is_xhr and request.method == 'POST':
         node.tags = create_tags(*request.get_json())
         node.save()
+        node_cache.invalidate(node.node_key)
         return jsonify({}), 202
 
     return redirect(url_for('manage.get_node', node_id=node.id))
@@ -415,37 +419,16 @@ def add_distributed():
     form.set_choices()
 
     if form.validate_on_submit():
-        nodes = []
-
-        if not form.nodes.data and not form.tags.data:
-            # all nodes get this query
-            nodes = Node.query.all()
-
-        if form.nodes.data:
-            nodes.extend(
-                Node.query.filter(
-                    Node.node_key.in_(form.nodes.data)
-                ).all()
-            )
-
-        if form.tags.data:
-            nodes.extend(
-                Node.query.filter(
-                    Node.tags.any(
-                        Tag.value.in_(form.tags.data)
-                    )
-                ).all()
-            )
-
         query = DistributedQuery.create(sql=form.sql.data,
                                         description=form.description.data,
                                         not_before=form.not_before.data)
 
-        for node in nodes:
-            task = DistributedQueryTask(node=node, distributed_query=query)
-            db.session.add(task)
-        else:
-            db.session.commit()
+        # with neither nodes nor tags selected, all nodes get this query
+        node_ids = create_distributed_query_tasks(query,
+                                                  node_keys=form.nodes.data,
+                                                  tags=form.tags.data)
+        db.session.commit()
+        pending_work.mark(*node_ids)
 
         return redirect(url_for('manage.distributed', status='new'))
 
@@ -593,6 +576,7 @@ def get_tag(tag_value):
 def delete_tag(tag_value):
     tag = Tag.query.filter(Tag.value == tag_value).first_or_404()
     tag.delete()
+    node_cache.invalidate()
     return jsonify({}), 204
 
 
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple
 import datetime as dt
 import string
 import uuid
 
 from flask_login import UserMixin
+from sqlalchemy import event
 
 from doorman.database import (
     Column,
@@ -208,35 +210,13 @@ class Pack(SurrogatePK, Model):
         }
 
 
-class Node(SurrogatePK, Model):
-
-    node_key = Column(db.String, nullable=False, unique=True)
-    enroll_secret = Column(db.String)
-    enrolled_on = Column(db.DateTime)
-    host_identifier = Column(db.String)
-    last_checkin = Column(db.DateTime)
-    node_info = Column(JSONB, default={}, nullable=False)
-    is_active = Column(db.Boolean, default=True, nullable=False)
-    last_ip = Column(INET, nullable=True)
-
-    tags = relationship(
-        'Tag',
-        secondary=node_tags,
-        back_populates='nodes',
-        lazy='joined',
-    )
-
-    def __init__(self, host_identifier, node_key=None,
-                 enroll_secret=None, enrolled_on=None, last_checkin=None,
-                 is_active=True, last_ip=None,
-                 **kwargs):
-        self.node_key = node_key or str(uuid.uuid4())
-        self.host_identifier = host_identifier
-        self.enroll_secret = enroll_secret
-        self.enrolled_on = enrolled_on
-        self.last_checkin = last_checkin
-        self.is_active = is_active
-        self.last_ip = last_ip
+class NodeMixin(object):
+    """
+    Behaviour shared by the Node model and its lightweight NodeRecord
+    snapshot. Everything here relies only on plain attributes (including
+    `tags`, a sequence of objects with `id` and `value` attributes), so
+    that it works whether or not the node is attached to a session.
+    """
 
     def __repr__(self):
         return '<Node-{0.id}: node_key={0.node_key}, host_identifier={0.host_identifier}>'.format(self)
@@ -262,31 +242,22 @@ class Node(SurrogatePK, Model):
 
     @property
     def packs(self):
-        return db.session.object_session(self) \
-            .query(Pack).join((Tag, Pack.tags)) \
+        return db.session.query(Pack).join((Tag, Pack.tags)) \
             .filter(Pack.tags.any(Tag.value.in_(t.value for t in self.tags))) \
             .distinct()
 
     @property
     def queries(self):
-        return db.session.object_session(self) \
-            .query(Query).join((Tag, Query.tags)) \
+        return db.session.query(Query).join((Tag, Query.tags)) \
             .filter(Query.tags.any(Tag.value.in_(t.value for t in self.tags))) \
             .distinct()
 
     @property
     def file_paths(self):
-        return db.session.object_session(self) \
-            .query(FilePath).join((Tag, FilePath.tags)) \
+        return db.session.query(FilePath).join((Tag, FilePath.tags)) \
             .filter(FilePath.tags.any(Tag.value.in_(t.value for t in self.tags))) \
             .distinct()
 
-    def get_recent(self, days=7, minutes=0, seconds=0):
-        now = dt.datetime.utcnow()
-        when = now - dt.timedelta(days=days, minutes=minutes, seconds=seconds)
-        return self.result_logs.filter(ResultLog.timestamp > when) \
-            .order_by(ResultLog.timestamp.desc(), ResultLog.id.desc())
-
     def to_dict(self):
         # NOTE: deliberately not including any secret values in here, for now.
         return {
@@ -301,6 +272,69 @@ class Node(SurrogatePK, Model):
         }
 
 
+class Node(NodeMixin, SurrogatePK, Model):
+
+    node_key = Column(db.String, nullable=False, unique=True)
+    enroll_secret = Column(db.String)
+    enrolled_on = Column(db.DateTime)
+    host_identifier = Column(db.String)
+    last_checkin = Column(db.DateTime)
+    node_info = Column(JSONB, default={}, nullable=False)
+    is_active = Column(db.Boolean, default=True, nullable=False)
+    last_ip = Column(INET, nullable=True)
+
+    tags = relationship(
+        'Tag',
+        secondary=node_tags,
+        back_populates='nodes',
+        lazy='joined',
+    )
+
+    def __init__(self, host_identifier, node_key=None,
+                 enroll_secret=None, enrolled_on=None, last_checkin=None,
+                 is_active=True, last_ip=None,
+                 **kwargs):
+        self.node_key = node_key or str(uuid.uuid4())
+        self.host_identifier = host_identifier
+        self.enroll_secret = enroll_secret
+        self.enrolled_on = enrolled_on
+        self.last_checkin = last_checkin
+        self.is_active = is_active
+        self.last_ip = last_ip
+
+    def get_recent(self, days=7, minutes=0, seconds=0):
+        now = dt.datetime.utcnow()
+        when = now - dt.timedelta(days=days, minutes=minutes, seconds=seconds)
+        return self.result_logs.filter(ResultLog.timestamp > when) \
+            .order_by(ResultLog.timestamp.desc(), ResultLog.id.desc())
+
+    def to_record(self):
+        return NodeRecord(
+            id=self.id,
+            node_key=self.node_key,
+            host_identifier=self.host_identifier,
+            is_active=self.is_active,
+            tags=tuple(TagRecord(id=t.id, value=t.value) for t in self.tags),
+            enrolled_on=self.enrolled_on,
+            last_checkin=self.last_checkin,
+            last_ip=self.last_ip,
+            node_info=self.node_info.copy(),
+        )
+
+
+TagRecord = namedtuple('TagRecord', ['id', 'value'])
+
+
+class NodeRecord(NodeMixin, namedtuple('NodeRecord', [
+        'id', 'node_key', 'host_identifier', 'is_active', 'tags',
+        'enrolled_on', 'last_checkin', 'last_ip', 'node_info'])):
+    """
+    A detached, read-only snapshot of a Node. This is what the osquery API
+    endpoints operate on, so that a node can be authenticated from the
+    NodeCache without a database round-trip.
+    """
+
+
 class FilePath(SurrogatePK, Model):
 
     category = Column(db.String, nullable=False, unique=True)
@@ -377,14 +411,17 @@ class StatusLog(SurrogatePK, Model):
 
     def __init__(self, line=None, message=None, severity=None,
                  filename=None, created=None, node=None, version=None,
-                 **kwargs):
+                 node_id=None, **kwargs):
         self.line = int(line)
         self.message = message
         self.severity = int(severity)
         self.filename = filename
         self.created = created
-        self.node = node
         self.version = version
+        if node:
+            self.node = node
+        elif node_id:
+            self.node_id = node_id
 
 
 class DistributedQuery(SurrogatePK, Model):
@@ -437,6 +474,11 @@ class DistributedQueryTask(SurrogatePK, Model):
             self.distributed_query_id = distributed_query_id
 
 
+# distributed_read claims a node's NEW tasks on every poll
+db.Index('idx__distributed_query_task__node_id__status',
+         DistributedQueryTask.node_id, DistributedQueryTask.status)
+
+
 class DistributedQueryResult(SurrogatePK, Model):
 
     columns = Column(JSONB)
@@ -485,6 +527,71 @@ class Rule(SurrogatePK, Model):
             name=self.name, description=self.description or '')
         )
 
+
+class Generation(SurrogatePK, Model):
+    """
+    A named counter, bumped whenever the data it stands for changes, so
+    that every process can tell when its cached copy of that data is stale.
+    """
+
+    name = Column(db.String, nullable=False, unique=True)
+    value = Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+
+    def __repr__(self):
+        return '<Generation {0.name}: {0.value}>'.format(self)
+
+
+def bump_generation_on(connection, name):
+    """
+    Bump a generation on `connection`, as part of the transaction it is in.
+    This is for mapper events, in which the session can't be used.
+    """
+    generation = Generation.__table__
+    updated = connection.execute(
+        generation.update()
+        .where(generation.c.name == name)
+        .values(value=generation.c.value + 1)
+    ).rowcount
+
+    if not updated:
+        connection.execute(generation.insert().values(name=name, value=1))
+
+
+@event.listens_for(Rule, 'after_insert')
+@event.listens_for(Rule, 'after_update')
+@event.listens_for(Rule, 'after_delete')
+def rule_changed(mapper, connection, target):
+    # However a rule is changed, make every rule manager reload the rules.
+    from doorman.utils import RULES_GENERATION
+    bump_generation_on(connection, RULES_GENERATION)
+
+
+@event.listens_for(FilePath, 'after_insert')
+@event.listens_for(FilePath, 'after_update')
+@event.listens_for(FilePath, 'after_delete')
+@event.listens_for(Pack, 'after_insert')
+@event.listens_for(Pack, 'after_update')
+@event.listens_for(Pack, 'after_delete')
+@event.listens_for(Query, 'after_insert')
+@event.listens_for(Query, 'after_update')
+@event.listens_for(Query, 'after_delete')
+@event.listens_for(Tag, 'after_delete')
+def configuration_changed(mapper, connection, target):
+    # However a pack, query or file path is changed, or a tag deleted, mark
+    # every cached osquery configuration as stale. Changing the tags of a
+    # pack, query or file path changes it too, but changing those of a node
+    # (which also changes the tag) doesn't change any configuration.
+    from doorman.extensions import config_cache
+    from doorman.utils import CONFIG_GENERATION
+
+    bump_generation_on(connection, CONFIG_GENERATION)
+    config_cache.invalidate()
+
+
 class User(UserMixin, SurrogatePK, Model):
 
     username = Column(db.String(80), unique=True, nullable=False)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import atexit
+import logging
+import threading
+import time
+
+from celery.signals import worker_process_shutdown
+from flask import current_app, has_app_context
+
+
+class DigestBatcher(object):
+    """
+    Collects an alerter's matches per rule, and hands them to `send` as one
+    digest, as a list of (node, match) tuples, once `max_size` matches have
+    been collected for the rule, or `interval` seconds after the first.
+
+    Digests due by time are sent from a background thread, within the
+    application context the first match was collected in; any pending
+    digests are sent when the worker process (or any other process) exits.
+
+    A digest that can't be sent is handed to `requeue`, if set, to be
+    retried elsewhere (see RuleManager.queue_digest), and otherwise logged
+    and dropped. Pending digests only live in the memory of the process
+    that collected them, so are lost if it is killed outright.
+    """
+    def __init__(self, send, interval=60, max_size=100):
+        self.send = send
+        self.requeue = None
+        self.interval = interval
+        self.max_size = max_size
+        self.pending = OrderedDict()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__ + '.DigestBatcher')
+
+    def add(self, node, match):
+        app = current_app._get_current_object() if has_app_context() else None
+
+        with self.lock:
+            digest = self.pending.get(match.rule.id)
+            if digest is None:
+                digest = self.pending[match.rule.id] = \
+                    (time.time() + self.interval, app, [])
+            digest[2].append((node, match))
+
+            if len(digest[2]) < self.max_size:
+                digest = None
+            else:
+                del self.pending[match.rule.id]
+
+            self.start()
+
+        if digest is not None:
+            self.deliver(digest)
+
+    def start(self):
+        # with self.lock held
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run,
+                                       name='doorman-alert-digests')
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Celery's pool processes exit without running atexit handlers.
+        worker_process_shutdown.connect(self.shutdown, weak=False)
+        atexit.register(self.flush, force=True)
+
+    def shutdown(self, **kwargs):
+        self.flush(force=True)
+
+    def run(self):
+        while True:
+            with self.lock:
+                deadlines = [deadline for deadline, _, _ in self.pending.values()]
+            timeout = min(deadlines) - time.time() if deadlines else self.interval
+
+            time.sleep(max(timeout, 0))
+            self.flush()
+
+    def flush(self, force=False):
+        """ Send every digest that is due, or every pending one if `force`. """
+        now = time.time()
+
+        with self.lock:
+            due = [rule_id for rule_id, (deadline, _, _) in self.pending.items()
+                   if force or deadline <= now]
+            digests = [self.pending.pop(rule_id) for rule_id in due]
+
+        for digest in digests:
+            self.deliver(digest)
+
+    def deliver(self, digest):
+        _, app, matches = digest
+
+        try:
+            if app is None:
+                self.send(matches)
+            else:
+                with app.app_context():
+                    self.send(matches)
+        except Exception:
+            if self.requeue is None:
+                self.logger.exception("Could not send a digest of %d "
+                                      "alert(s)", len(matches))
+                return
+
+            self.logger.warning("Could not send a digest of %d alert(s), "
+                                "queueing it to be retried", len(matches),
+                                exc_info=True)
+            try:
+                self.requeue(matches)
+            except Exception:
+                self.logger.exception("Could not queue a digest of %d "
+                                      "alert(s)", len(matches))
@@ -6,6 +6,7 @@ from flask_mail import Message
 
 from doorman.extensions import mail
 from .base import AbstractAlerterPlugin
+from .digest import DigestBatcher
 
 
 class EmailAlerter(AbstractAlerterPlugin):
@@ -16,7 +17,20 @@ class EmailAlerter(AbstractAlerterPlugin):
         self.message_template = config.get('message_template', 'email/alert.body.txt')
         self.subject_prefix = config.get('subject_prefix', '[Doorman]')
 
+        # Optionally, send one email per rule for every `max_size` matches,
+        # or every `interval` seconds, rather than one per match.
+        self.digest = None
+        if config.get('digest'):
+            self.digest = DigestBatcher(self.send_digest, **config['digest'])
+            self.digest_subject_template = config.get(
+                'digest_subject_template', 'email/digest.subject.txt')
+            self.digest_message_template = config.get(
+                'digest_message_template', 'email/digest.body.txt')
+
     def handle_alert(self, node, match):
+        if self.digest is not None:
+            return self.digest.add(node, match)
+
         subject = render_template(
             self.subject_template,
             prefix=self.subject_prefix,
@@ -32,6 +46,29 @@ class EmailAlerter(AbstractAlerterPlugin):
             node=node
         )
 
+        return self.send(subject, body)
+
+    def send_digest(self, matches):
+        rule = matches[0][1].rule
+
+        subject = render_template(
+            self.digest_subject_template,
+            prefix=self.subject_prefix,
+            rule=rule,
+            matches=matches,
+            timestamp=dt.datetime.utcnow(),
+        )
+
+        body = render_template(
+            self.digest_message_template,
+            rule=rule,
+            matches=matches,
+            timestamp=dt.datetime.utcnow(),
+        )
+
+        return self.send(subject, body)
+
+    def send(self, subject, body):
         message = Message(
             subject.strip(),
             recipients=self.recipients,
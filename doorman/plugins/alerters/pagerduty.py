@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-
-import requests
+import uuid
 
 from doorman.utils import DateTimeEncoder
 from .base import AbstractAlerterPlugin
+from .digest import DigestBatcher
+from .session import get_session
 
 
 DEFAULT_KEY_FORMAT = 'doorman-incident-{count}'
+DEFAULT_URL = 'https://events.pagerduty.com/generic/2010-04-15/create_event.json'
 
 
 class PagerDutyAlerter(AbstractAlerterPlugin):
@@ -19,32 +21,76 @@ class PagerDutyAlerter(AbstractAlerterPlugin):
         # Optional
         self.client_url = config.get('client_url', '')
         self.key_format = config.get('key_format', DEFAULT_KEY_FORMAT)
+        self.url = config.get('url', DEFAULT_URL)
+
+        # Options for the session shared by PagerDuty alerters configured
+        # alike, see HTTPSession for timeouts, pooling and circuit breaking.
+        self.session = get_session('pagerduty', **config.get('http', {}))
+
+        # Optionally, trigger one event per rule for every `max_size`
+        # matches, or every `interval` seconds, rather than one per match.
+        self.digest = None
+        if config.get('digest'):
+            self.digest = DigestBatcher(self.send_digest, **config['digest'])
 
         # Other
         self.incident_count = 0
         self.logger = logging.getLogger(__name__ + '.PagerDutyAlerter')
 
     def handle_alert(self, node, match):
-        self.incident_count += 1
-        key = self.key_format.format(
-            count=self.incident_count
-        )
+        if self.digest is not None:
+            return self.digest.add(node, match)
 
         description = match.rule.template.safe_substitute(
             match.result['columns'],
             **node
         ).rstrip()
 
-        description = ":".join(description.split('\r\n\r\n', 1))
-
         details = {
             'node': node,
             'rule_name': match.rule.name,
             'rule_description': match.rule.description,
             'action': match.result['action'],
             'match': match.result['columns'],
+            'suppressed': match.suppressed,
+        }
+
+        self.trigger(match.rule, description, details)
+
+    def send_digest(self, matches):
+        rule = matches[0][1].rule
+
+        description = rule.template.safe_substitute(
+            matches[0][1].result['columns'],
+            **matches[0][0]
+        ).rstrip()
+        description = u'{0} matches of {1}'.format(len(matches), description)
+
+        details = {
+            'rule_name': rule.name,
+            'rule_description': rule.description,
+            'matches': [{
+                'node': node,
+                'action': match.result['action'],
+                'match': match.result['columns'],
+                'suppressed': match.suppressed,
+            } for node, match in matches],
         }
 
+        self.trigger(rule, description, details)
+
+    def trigger(self, rule, description, details):
+        # `count` restarts from 1 with every process, so a format using it
+        # can reuse the key of an existing incident; `uuid` can't.
+        self.incident_count += 1
+        key = self.key_format.format(
+            count=self.incident_count,
+            uuid=uuid.uuid4(),
+            rule_id=rule.id,
+        )
+
+        description = ":".join(description.split('\r\n\r\n', 1))
+
         headers = {
             'Content-type': 'application/json',
         }
@@ -59,8 +105,8 @@ class PagerDutyAlerter(AbstractAlerterPlugin):
             'details': details,
         }, cls=DateTimeEncoder)
 
-        resp = requests.post(
-            'https://events.pagerduty.com/generic/2010-04-15/create_event.json',
+        resp = self.session.post(
+            self.url,
             headers=headers,
             data=payload
         )
@@ -3,14 +3,64 @@ import string
 
 from flask import current_app
 from raven import Client
+from raven.exceptions import APIError, RateLimited
+from raven.transport.threaded import ThreadedHTTPTransport
 
 from .base import AbstractAlerterPlugin
+from .session import get_session
+
+
+class SessionTransport(ThreadedHTTPTransport):
+    """
+    Sends events to Sentry from raven's background worker, as by default,
+    but through an alerter's HTTPSession rather than with a new connection
+    per event.
+    """
+    scheme = ['session+http', 'session+https']
+    session = None
+
+    def send(self, data, headers):
+        resp = self.session.post(
+            self._url,
+            data=data,
+            headers=headers,
+            verify=self.ca_certs if self.verify_ssl else False,
+        )
+        if resp.status_code >= 400:
+            # As raven's HTTPTransport, so that the client backs off when
+            # Sentry rate limits us.
+            msg = resp.headers.get('x-sentry-error')
+            if resp.status_code == 429:
+                try:
+                    retry_after = int(resp.headers.get('retry-after'))
+                except (ValueError, TypeError):
+                    retry_after = 0
+                raise RateLimited(msg, retry_after)
+            elif msg:
+                raise APIError(msg, resp.status_code)
+            resp.raise_for_status()
+        return resp
+
+    def send_sync(self, data, headers, success_cb, failure_cb):
+        try:
+            self.send(data, headers)
+        except Exception as e:
+            failure_cb(e)
+        else:
+            success_cb()
 
 
 class SentryAlerter(AbstractAlerterPlugin):
     def __init__(self, config):
+        # Options for the session shared by Sentry alerters configured
+        # alike, see HTTPSession for timeouts, pooling and circuit breaking.
+        session = get_session('sentry', **config.get('http', {}))
+        transport = type('SessionTransport', (SessionTransport, ),
+                         {'session': session})
+
         self.client = Client(
             config['dsn'],
+            transport=transport,
             auto_log_stacks=False,
             enable_breadcrumbs=False,
         )
@@ -42,6 +92,7 @@ class SentryAlerter(AbstractAlerterPlugin):
                 'columns': match.result['columns'],
                 'timestamp': match.result['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
                 'node': node,
+                'suppressed': match.suppressed,
             },
             tags={
                 'host_identifier': node.get('host_identifier'),
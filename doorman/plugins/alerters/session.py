@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(requests.RequestException):
+    """ Raised, without making a request, while a session's circuit is open. """
+
+
+class HTTPSession(object):
+    """
+    A requests session for alerters that talk to a remote service, which:
+
+    - keeps up to `pool_maxsize` connections per host alive between alerts,
+      rather than making a new TCP and TLS connection for each;
+    - gives up on requests after `timeout`, either seconds or a (connect,
+      read) tuple of seconds, unless a request passes its own;
+    - makes at most `max_concurrency` requests at a time, others waiting
+      for their turn;
+    - after `failure_threshold` consecutive failures (connection errors,
+      timeouts, 429 or 5xx responses), raises CircuitOpenError for every request
+      for `reset_timeout` seconds; the first request after that is let
+      through, and closes the circuit again if it succeeds.
+    """
+    def __init__(self, timeout=(3.05, 10), pool_connections=10,
+                 pool_maxsize=10, max_concurrency=10, failure_threshold=5,
+                 reset_timeout=30):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        if isinstance(timeout, list):
+            timeout = tuple(timeout)
+        self.timeout = timeout
+
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__ + '.HTTPSession')
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        if not self.allow_request():
+            raise CircuitOpenError(
+                'Not sending {0} {1}, after {2} consecutive failure(s)'.format(
+                    method, url, self.failures))
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        with self.semaphore:
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                self.record(False)
+                raise
+
+        self.record(resp.status_code < 500 and resp.status_code != 429)
+        return resp
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+
+            # Let this request through, and keep the circuit open for
+            # others until it has told us whether the service is back.
+            self.opened_at = time.time()
+            return True
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                if self.opened_at is not None:
+                    self.logger.info('Closing circuit')
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.logger.warning(
+                        'Opening circuit for %d second(s), after %d '
+                        'consecutive failure(s)', self.reset_timeout,
+                        self.failures)
+                self.opened_at = time.time()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name, **options):
+    """
+    Returns the HTTPSession for the alerters called `name` (e.g. the kind
+    of service they talk to), configured with `options`, so alerters
+    configured alike share its connections and circuit.
+    """
+    key = (name, tuple(sorted(
+        (option, tuple(value) if isinstance(value, list) else value)
+        for option, value in options.items())))
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = HTTPSession(**options)
+        return session
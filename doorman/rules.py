@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import re
 import logging
-from collections import namedtuple
+from collections import deque, namedtuple
 
 import six
 
@@ -10,7 +10,23 @@ logger = logging.getLogger(__name__)
 
 
 RuleInput = namedtuple('RuleInput', ['result_log', 'node'])
-RuleMatch = namedtuple('RuleMatch', ['rule', 'result', 'node'])
+RuleMatch = namedtuple('RuleMatch', ['rule', 'result', 'node', 'suppressed'])
+
+# the number of alerts suppressed by the alert throttle before this match
+RuleMatch.__new__.__defaults__ = (0, )
+
+# An immutable copy of a Rule, as loaded by the rule manager, so that
+# alerters can be given the rule that matched without a database query.
+RuleSnapshot = namedtuple('RuleSnapshot', ['id', 'name', 'description',
+                                           'alerters', 'template'])
+
+# Marks a condition that has not yet been evaluated for the current input.
+UNSET = object()
+
+# At least this many string conditions of the same kind on the same value
+# are evaluated together, with a single scan of the value; below this,
+# scanning for each pattern in turn is cheaper.
+PATTERN_GROUP_MIN_SIZE = 32
 
 
 class Network(object):
@@ -21,6 +37,12 @@ class Network(object):
     def __init__(self):
         self.conditions = {}
         self.alert_conditions = []
+        self.by_query_name = {}
+        self.catch_all = []
+        self.memo_size = 0
+        self.condition_count = 0
+        self.compiled = False
+        self.pattern_group_min_size = PATTERN_GROUP_MIN_SIZE
 
     def make_condition(self, klass, *args, **kwargs):
         """
@@ -52,34 +74,246 @@ class Network(object):
             return self.conditions[key]
 
         # Instantiate the condition class.  Also, save the memoization key on
-        # the class, so it can be retrieved (above).
+        # the class, so it can be retrieved (above), and give the condition
+        # a slot in which to store its value while processing an input.
         inst = klass(*args, **kwargs)
         inst.__network_memo_key = key
+        inst.slot = len(self.conditions)
 
         # Save the condition
         self.conditions[key] = inst
+        self.compiled = False
         return inst
 
     def make_alert_condition(self, alert, dependent, rule_id=None):
         self.alert_conditions.append((alert, dependent, rule_id))
+        self.compiled = False
 
-    def process(self, entry, node):
-        input = RuleInput(result_log=entry, node=node)
+    def compile(self):
+        """
+        Compile every alert condition into a function of (entry, node, memo),
+        returning whether the condition holds.  Each condition is compiled
+        once, so conditions shared between rules are evaluated at most once
+        per input, with their value stored in the condition's slot of `memo`.
+
+        Each is also compiled into a function of (batch, mask), used by
+        `process_batch`, returning the mask of entries for which it holds.
+        """
+        local_evaluators = {}
+        evaluators = {}
+        batch_evaluators = {}
+        self.memo_size = self.assign_value_slots(len(self.conditions))
+        scanners = self.group_conditions()
+
+        def compile_local(condition):
+            evaluate = local_evaluators.get(condition.slot)
+            if evaluate is None:
+                evaluate = condition.compile(compile_condition)
+                if condition.slot in scanners:
+                    evaluate = condition.compile_scanned(
+                        scanners[condition.slot], evaluate)
+                local_evaluators[condition.slot] = evaluate
+            return evaluate
+
+        def compile_condition(condition):
+            evaluate = evaluators.get(condition.slot)
+            if evaluate is None:
+                evaluate = evaluators[condition.slot] = memoize(
+                    compile_local(condition), condition.slot)
+            return evaluate
+
+        def compile_batch_condition(condition):
+            evaluate = batch_evaluators.get(condition.slot)
+            if evaluate is None:
+                if condition.slot in scanners:
+                    # evaluated entry by entry, to share the group's scan
+                    evaluate = evaluate_each(compile_local(condition))
+                else:
+                    evaluate = condition.compile_batch(
+                        compile_batch_condition, compile_local)
+                evaluate = batch_evaluators[condition.slot] = memoize_batch(
+                    evaluate, condition.slot)
+            return evaluate
+
+        # Bucket alert conditions by the query names they can possibly match,
+        # so that an input is only evaluated against candidate rules. Those
+        # that don't constrain the query name go in a catch-all bucket.
+        self.by_query_name = {}
+        self.catch_all = []
+
+        for alert, upstream, rule_id in self.alert_conditions:
+            compiled = (alert, compile_condition(upstream), rule_id,
+                        upstream.constraint('action'),
+                        compile_batch_condition(upstream))
+
+            query_names = upstream.constraint('query_name')
+            if query_names is None:
+                self.catch_all.append(compiled)
+                continue
+
+            for query_name in query_names:
+                self.by_query_name.setdefault(query_name, []).append(compiled)
+
+        self.compiled = True
+
+    def assign_value_slots(self, slot):
+        """
+        Give each value that conditions convert before comparing it (e.g.,
+        a column) a slot of `memo`, starting at `slot`, so that it is
+        extracted and converted at most once per input, for all of the
+        conditions on it.  Returns the next free slot.
+        """
+        slots = {}
+        for condition in self.conditions.values():
+            value_key = getattr(condition, 'value_key', None)
+            if value_key is None:
+                continue
+
+            value_key = value_key()
+            if value_key is None:
+                condition.value_slot = None
+                continue
+
+            if value_key not in slots:
+                slots[value_key] = slot
+                slot += 1
+            condition.value_slot = slots[value_key]
 
-        # Step 1: Mark all conditions as 'not evaluated'.
+        return slot
+
+    def group_conditions(self):
+        """
+        Group string conditions (e.g., contains) of the same kind on the same
+        value, so that all of a group's patterns are matched with a single
+        scan of the value, rather than one scan per condition.
+
+        Conditions are only grouped with others reachable from rules for the
+        same query names, so that an input is not scanned for the patterns
+        of rules it is never evaluated against.
+
+        Returns a dict from the slot of each grouped condition to a function
+        of (entry, node, memo) returning the result of its group's scan.
+        Each group stores that result in its own slot of `memo`, after those
+        already in use.
+        """
+        # The query names each condition may be evaluated for, or None if
+        # it is reachable from a rule that doesn't constrain the query name.
+        query_names = {}
+
+        def visit(condition, names):
+            if condition.slot in query_names:
+                seen = query_names[condition.slot]
+                if seen is None or (names is not None and names <= seen):
+                    return
+                names = None if names is None else seen | names
+
+            query_names[condition.slot] = names
+            for upstream in getattr(condition, 'upstream', ()):
+                visit(upstream, names)
+
+        for _, upstream, _ in self.alert_conditions:
+            visit(upstream, upstream.constraint('query_name'))
+
+        groups = {}
         for condition in self.conditions.values():
-            condition.evaluated = False
+            group_class = getattr(condition, 'pattern_group', None)
+            if group_class is None or not group_class.accepts(condition):
+                continue
+
+            key = (group_class, condition.key, condition.column_name,
+                   query_names.get(condition.slot))
+            groups.setdefault(key, []).append(condition)
+
+        scanners = {}
+        slot = self.memo_size
+
+        for (group_class, _, _, _), conditions in groups.items():
+            if len(conditions) < self.pattern_group_min_size:
+                continue
+
+            scan = group_class(conditions).compile(slot)
+            if scan is None:
+                continue
+
+            for condition in conditions:
+                scanners[condition.slot] = scan
+            slot += 1
+
+        self.condition_count = len(self.conditions)
+        self.memo_size = slot
+        return scanners
+
+    def candidates(self, entry):
+        """
+        Returns the compiled alert conditions that could match an input.
+        """
+        query_name = maybe_make_number(entry.get('name'))
+        action = maybe_make_number(entry.get('action'))
+
+        for compiled in self.by_query_name.get(query_name, ()):
+            if compiled[3] is None or action in compiled[3]:
+                yield compiled
+
+        for compiled in self.catch_all:
+            if compiled[3] is None or action in compiled[3]:
+                yield compiled
+
+    def process(self, entry, node):
+        if not self.compiled:
+            self.compile()
+
+        # For each candidate alert condition, we evaluate its compiled
+        # condition on the new input.  This evaluates the dependent chain
+        # of conditions, short-circuiting as soon as the outcome is known,
+        # and remembering each condition's value in `memo` for any other
+        # rule that shares the condition.
+        memo = [UNSET] * self.memo_size
 
-        # Step 2: For each alerter condition, we tell it to 'process' a new
-        # input.  This will propagate "upstream" to each condition node and
-        # evaluate the dependent chain of conditions.  We then check if the
-        # condition has triggered.
         alerts = set()
-        for (alert, upstream, rule_id) in self.alert_conditions:
-            if upstream.run(input):
+        for (alert, evaluate, rule_id, _, _) in self.candidates(entry):
+            if evaluate(entry, node, memo):
                 alerts.add((alert, rule_id))
 
-        # Step 3: Return all alerts to the caller.
+        return alerts
+
+    def process_batch(self, entries, node):
+        """
+        Evaluate every entry of a batch from the same node, returning a list
+        with the set of alerts for each entry, as `process` would.
+
+        Rather than walking the conditions once per entry, each condition is
+        evaluated across all of the entries that reach it, with the entries
+        for which it holds returned as a bitmask (bit i for entries[i]).
+        An AND only evaluates an upstream for the entries for which the
+        previous ones held, and an OR for those for which none have, so that
+        each condition sees exactly the entries it would one at a time.
+        """
+        if not self.compiled:
+            self.compile()
+
+        batch = Batch(entries, node, self.condition_count)
+
+        # Entries for the same query name and action have the same candidate
+        # rules, so find the entries each rule should be evaluated for.
+        groups = {}
+        for index, entry in enumerate(entries):
+            key = (entry.get('name'), entry.get('action'))
+            groups.setdefault(key, []).append(index)
+
+        active = {}
+        for indices in groups.values():
+            mask = make_mask(indices)
+            for compiled in self.candidates(entries[indices[0]]):
+                if id(compiled) in active:
+                    active[id(compiled)][1] |= mask
+                else:
+                    active[id(compiled)] = [compiled, mask]
+
+        alerts = [set() for _ in entries]
+        for (alert, _, rule_id, _, evaluate), mask in active.values():
+            for index in iter_bits(evaluate(batch, mask)):
+                alerts[index].add((alert, rule_id))
+
         return alerts
 
     def parse_query(self, query, alerters=None, rule_id=None):
@@ -140,6 +374,284 @@ class Network(object):
                 self.make_alert_condition(alert, root, rule_id)
 
 
+def maybe_make_number(value):
+    """
+    Convert a string to an int or float, if it looks like one.
+    """
+    if not isinstance(value, six.string_types):
+        return value
+
+    if value.isdigit():
+        return int(value)
+    elif '.' in value and value.replace('.', '', 1).isdigit():
+        return float(value)
+
+    return value
+
+
+class AhoCorasick(object):
+    """
+    An Aho-Corasick automaton, which finds every occurrence of any of a set
+    of substrings in a single pass over a string.
+    """
+    def __init__(self, patterns):
+        goto = [{}]
+        output = [set()]
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = goto[state][char] = len(goto)
+                    goto.append({})
+                    output.append(set())
+                state = next_state
+            output[state].add(pattern)
+
+        # Breadth-first, so each state's failure link points at a state
+        # whose links have already been computed.
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+
+                fail[next_state] = goto[link].get(char, 0)
+                output[next_state] |= output[fail[next_state]]
+
+        self.goto = goto
+        self.fail = fail
+        self.output = [frozenset(o) for o in output]
+
+    def search(self, value):
+        """ Returns the set of patterns found in `value`. """
+        goto, fail, output = self.goto, self.fail, self.output
+
+        found = set()
+        state = 0
+        for char in value:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class PatternGroup(object):
+    """
+    String conditions of one kind, all on the same value, which are matched
+    together with a single scan of the value.
+    """
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.get_value = conditions[0].compile_value()
+
+    @classmethod
+    def accepts(cls, condition):
+        return isinstance(condition.expected, six.string_types) and \
+            len(condition.expected) > 0
+
+    def make_scanner(self):
+        """
+        Returns a function scanning a string value for every pattern of the
+        group, or None if the group can't be matched together.
+        """
+        raise NotImplementedError()
+
+    def compile(self, slot):
+        """
+        Returns a function of (entry, node, memo) that scans the group's
+        value at most once per input, storing the result in `memo[slot]`.
+        The result is None if the value isn't a string, in which case each
+        condition should be evaluated on its own.
+        """
+        scan = self.make_scanner()
+        if scan is None:
+            return None
+
+        get_value = self.get_value
+
+        def scanned(entry, node, memo):
+            found = memo[slot]
+            if found is UNSET:
+                value = get_value(entry, node, memo)
+                if isinstance(value, six.string_types):
+                    found = memo[slot] = scan(value)
+                else:
+                    found = memo[slot] = None
+            return found
+        return scanned
+
+
+class SubstringGroup(PatternGroup):
+    """ Finds which of the group's substrings a value contains. """
+    def make_scanner(self):
+        return AhoCorasick(set(c.expected for c in self.conditions)).search
+
+
+class PrefixGroup(PatternGroup):
+    """ Finds which of the group's prefixes a value begins with. """
+    def make_scanner(self):
+        prefixes = frozenset(c.expected for c in self.conditions)
+        lengths = sorted(set(len(prefix) for prefix in prefixes))
+
+        def scan(value):
+            found = set()
+            for length in lengths:
+                if length > len(value):
+                    break
+                if value[:length] in prefixes:
+                    found.add(value[:length])
+            return found
+        return scan
+
+
+class RegexGroup(PatternGroup):
+    """
+    Checks whether a value matches any of the group's regular expressions,
+    with a single alternation of them all.  Since only the first matching
+    alternative is known, this is used to rule out the (common) inputs
+    matching none of them; otherwise, each condition is evaluated on its own.
+    """
+    # back-references and conditionals refer to groups by number, which
+    # would change once combined with other patterns
+    GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    @classmethod
+    def accepts(cls, condition):
+        # inline flags, e.g. (?x), apply to the whole pattern they appear
+        # in, so would apply to every pattern combined with them (or, on
+        # Python 3.11 and later, fail to compile)
+        expected = condition.expected
+        pattern = expected.pattern
+        return isinstance(pattern, six.string_types) and \
+            not cls.GROUP_REFERENCE.search(pattern) and \
+            expected.flags == re.compile(pattern[:0]).flags
+
+    def make_scanner(self):
+        patterns = sorted(set(c.expected.pattern for c in self.conditions))
+
+        # Python 2 can't compile a pattern with more than 100 groups, and
+        # raises AssertionError rather than re.error for it
+        try:
+            combined = re.compile('|'.join('(?:{0})'.format(p) for p in patterns))
+        except (re.error, AssertionError):
+            return None
+
+        return lambda value: combined.match(value) is not None
+
+
+def memoize(evaluate, slot):
+    """
+    Wrap a compiled condition, so it is evaluated at most once per input.
+    """
+    def memoized(entry, node, memo):
+        value = memo[slot]
+        if value is UNSET:
+            value = memo[slot] = evaluate(entry, node, memo)
+        return value
+    return memoized
+
+
+def memoize_batch(evaluate, slot):
+    """
+    Wrap a compiled batch condition, so it is evaluated at most once per
+    entry of a batch.  `batch.memo[slot]` holds the mask of the entries it
+    was evaluated for, and the mask of those for which it held.
+    """
+    def memoized(batch, active):
+        evaluated, holds = batch.memo[slot]
+        pending = active & ~evaluated
+        if pending:
+            holds |= evaluate(batch, pending)
+            batch.memo[slot] = (evaluated | pending, holds)
+        return holds & active
+    return memoized
+
+
+def make_mask(indices):
+    """
+    Returns a mask with the bits at `indices` set, which must be ascending.
+    """
+    if not indices:
+        return 0
+
+    bits = bytearray(b'0' * (indices[-1] + 1))
+    for index in indices:
+        bits[-1 - index] = ord('1')
+    return int(bytes(bits), 2)
+
+
+def iter_bits(mask):
+    """
+    Yields the indices of the bits set in a mask, in ascending order.
+    """
+    bits = bin(mask)[:1:-1]
+    index = bits.find('1')
+    while index >= 0:
+        yield index
+        index = bits.find('1', index + 1)
+
+
+def evaluate_each(evaluate):
+    """
+    Returns a function of (batch, mask) that calls a compiled condition for
+    each entry in the mask, returning the mask of those for which it held.
+    """
+    def evaluate_batch(batch, active):
+        entries, node, memo_for = batch.entries, batch.node, batch.memo_for
+        return make_mask([
+            index for index in iter_bits(active)
+            if evaluate(entries[index], node, memo_for(index))
+        ])
+    return evaluate_batch
+
+
+class Batch(object):
+    """
+    The entries of a batch from the same node, and the memo of the mask of
+    entries each of its conditions holds for.  Per-entry memos, as used by
+    `Network.process`, are created for the entries as they are evaluated.
+    """
+    def __init__(self, entries, node, condition_count):
+        self.entries = entries
+        self.node = node
+        self.memo = [(0, 0)] * condition_count
+        self.memos = {}
+        self.columns = {}
+
+    def column(self, key):
+        """
+        Returns the list of the values conditions compare, for each entry,
+        shared by all of the conditions on the same value.  A value is UNSET
+        until extracted for its entry.
+        """
+        values = self.columns.get(key)
+        if values is None:
+            values = self.columns[key] = [UNSET] * len(self.entries)
+        return values
+
+    def memo_for(self, index):
+        memo = self.memos.get(index)
+        if memo is None:
+            memo = self.memos[index] = EntryMemo()
+        return memo
+
+
+class EntryMemo(dict):
+    """ A sparse per-entry memo, for pattern group scans. """
+    def __missing__(self, slot):
+        return UNSET
+
+
 class BaseCondition(object):
     """
     Base class for conditions.  Contains the logic for adding a dependency to a
@@ -176,6 +688,45 @@ class BaseCondition(object):
         """
         raise NotImplementedError()
 
+    def constraint(self, key):
+        """
+        Returns the set of values that `key` (e.g., 'query_name') must have
+        for this condition to hold, or None if that can't be determined.
+        """
+        return None
+
+    def compile_scanned(self, scanned, evaluate):
+        """
+        Returns a function of (entry, node, memo) that evaluates this
+        condition from the result of its pattern group's scan, or with
+        `evaluate` when there is none.  Only conditions with a
+        `pattern_group` need implement this.
+        """
+        raise NotImplementedError()
+
+    def compile(self, compile_condition):
+        """
+        Returns a function of (entry, node, memo) that runs this condition's
+        logic.  Upstream conditions should be compiled with
+        `compile_condition`.  Subclasses may override this to avoid
+        constructing a RuleInput for every input.
+        """
+        local_run = self.local_run
+
+        def evaluate(entry, node, memo):
+            return local_run(RuleInput(result_log=entry, node=node))
+        return evaluate
+
+    def compile_batch(self, compile_batch_condition, compile_local):
+        """
+        Returns a function of (batch, mask) that runs this condition for
+        each entry in the mask, returning the mask of those for which it
+        holds.  Upstream conditions should be compiled with
+        `compile_batch_condition`.  By default, this calls the function
+        from `compile_local`, as from `compile`, for each entry.
+        """
+        return evaluate_each(compile_local(self))
+
     def __repr__(self):
         return '<{0} (evaluated={1})>'.format(
             self.__class__.__name__,
@@ -195,6 +746,38 @@ class AndCondition(BaseCondition):
 
         return True
 
+    def constraint(self, key):
+        # every upstream must hold, so the value must satisfy all of them
+        values = None
+        for u in self.upstream:
+            constraint = u.constraint(key)
+            if constraint is None:
+                continue
+            values = constraint if values is None else values & constraint
+        return values
+
+    def compile(self, compile_condition):
+        upstream = tuple(compile_condition(u) for u in self.upstream)
+
+        def evaluate(entry, node, memo):
+            for u in upstream:
+                if not u(entry, node, memo):
+                    return False
+            return True
+        return evaluate
+
+    def compile_batch(self, compile_batch_condition, compile_local):
+        upstream = tuple(compile_batch_condition(u) for u in self.upstream)
+
+        def evaluate(batch, active):
+            # narrow down to the entries for which every upstream holds
+            for u in upstream:
+                active = u(batch, active)
+                if not active:
+                    break
+            return active
+        return evaluate
+
 
 class OrCondition(BaseCondition):
     def __init__(self, upstream):
@@ -208,8 +791,44 @@ class OrCondition(BaseCondition):
 
         return False
 
+    def constraint(self, key):
+        # any upstream may hold, so each of them must constrain the value
+        values = frozenset()
+        for u in self.upstream:
+            constraint = u.constraint(key)
+            if constraint is None:
+                return None
+            values = values | constraint
+        return values
+
+    def compile(self, compile_condition):
+        upstream = tuple(compile_condition(u) for u in self.upstream)
+
+        def evaluate(entry, node, memo):
+            for u in upstream:
+                if u(entry, node, memo):
+                    return True
+            return False
+        return evaluate
+
+    def compile_batch(self, compile_batch_condition, compile_local):
+        upstream = tuple(compile_batch_condition(u) for u in self.upstream)
+
+        def evaluate(batch, active):
+            # only evaluate each upstream for entries none has held for yet
+            holds = 0
+            for u in upstream:
+                holds |= u(batch, active & ~holds)
+                if holds == active:
+                    break
+            return holds
+        return evaluate
+
 
 class LogicCondition(BaseCondition):
+    # the slot of the network's memo holding the converted value, if any
+    value_slot = None
+
     def __init__(self, key, expected, column_name=None):
         super(LogicCondition, self).__init__()
         self.key = key
@@ -217,15 +836,7 @@ class LogicCondition(BaseCondition):
         self.column_name = column_name
 
     def maybe_make_number(self, value):
-        if not isinstance(value, six.string_types):
-            return value
-
-        if value.isdigit():
-            return int(value)
-        elif '.' in value and value.replace('.', '', 1).isdigit():
-            return float(value)
-
-        return value
+        return maybe_make_number(value)
 
     def local_run(self, input):
         # If we have a 'column_name', we should use that to extract the value
@@ -251,6 +862,100 @@ class LogicCondition(BaseCondition):
         logger.debug("Running logic condition %r: %r | %r", self, self.expected, value)
         return self.compare(value)
 
+    def compile(self, compile_condition):
+        compare = self.compare
+
+        if self.value_key() is None:
+            get_value = self.compile_getter()
+
+            def evaluate(entry, node, memo):
+                return compare(get_value(entry, node))
+            return evaluate
+
+        get_value = self.compile_value()
+
+        def evaluate(entry, node, memo):
+            return compare(get_value(entry, node, memo))
+        return evaluate
+
+    def compile_batch(self, compile_batch_condition, compile_local):
+        # Each value is extracted and converted once per batch, for all of
+        # the conditions on it.
+        value_key = self.value_key() or (self.key, self.column_name, None)
+        get_value = self.compile_getter()
+        maybe_make_number = self.maybe_make_number
+        if self.value_key() is None:
+            maybe_make_number = lambda value: value
+        compare = self.compare
+
+        def evaluate(batch, active):
+            entries, node = batch.entries, batch.node
+            values = batch.column(value_key)
+
+            holds = []
+            for index in iter_bits(active):
+                value = values[index]
+                if value is UNSET:
+                    value = values[index] = maybe_make_number(
+                        get_value(entries[index], node))
+                if compare(value):
+                    holds.append(index)
+            return make_mask(holds)
+        return evaluate
+
+    def value_key(self):
+        """
+        Returns a key identifying the value this condition compares, once
+        converted, or None if it compares the value as it is.  Conditions
+        with the same key share the converted value.
+        """
+        return (self.key, self.column_name, type(self).maybe_make_number)
+
+    def compile_value(self):
+        """
+        Returns a function of (entry, node, memo) that extracts the value this
+        condition compares, converted to a number if it looks like one.  With
+        a `value_slot`, the value is kept in that slot of `memo` for every
+        condition on it.
+        """
+        get_value = self.compile_getter()
+        maybe_make_number = self.maybe_make_number
+        slot = self.value_slot
+
+        if slot is None:
+            return lambda entry, node, memo: maybe_make_number(get_value(entry, node))
+
+        def get_number(entry, node, memo):
+            value = memo[slot]
+            if value is UNSET:
+                value = memo[slot] = maybe_make_number(get_value(entry, node))
+            return value
+        return get_number
+
+    def compile_getter(self):
+        """
+        Returns a function of (entry, node) that extracts the value this
+        condition compares, as local_run does.
+        """
+        column_name = self.column_name
+
+        if column_name is not None:
+            return lambda entry, node: entry['columns'].get(column_name)
+        elif self.key == 'query_name':
+            return lambda entry, node: entry['name']
+        elif self.key == 'timestamp':
+            return lambda entry, node: entry['timestamp']
+        elif self.key == 'action':
+            return lambda entry, node: entry['action']
+        elif self.key == 'host_identifier':
+            return lambda entry, node: node['host_identifier']
+
+        key = self.key
+
+        def unknown_key(entry, node):
+            raise KeyError('Unknown key: {0}'.format(key))
+        return unknown_key
+
     def compare(self, value):
         """
         Subclasses should implement this to run the actual comparison.
@@ -262,28 +967,84 @@ class EqualCondition(LogicCondition):
     def compare(self, value):
         return value == self.expected
 
+    def value_key(self):
+        return compare_as_is(self)
+
+    def constraint(self, key):
+        if self.column_name is None and self.key == key:
+            try:
+                return frozenset([self.expected])
+            except TypeError:  # unhashable
+                pass
+        return None
+
 
 class NotEqualCondition(LogicCondition):
     def compare(self, value):
         return value != self.expected
 
+    def value_key(self):
+        return compare_as_is(self)
+
+
+def compare_as_is(condition):
+    """
+    Returns None, so that an (in)equality condition compares values without
+    converting them, if its expected value is a string.  Since any string
+    that looks like a number was converted when the rule was parsed,
+    neither a value that is converted to a number, nor one that already
+    is, can equal it.
+    """
+    if isinstance(condition.expected, six.string_types):
+        return None
+    return LogicCondition.value_key(condition)
+
+
+class FoundCondition(LogicCondition):
+    """
+    A condition that holds when its pattern group's scan of a value found
+    the expected pattern, or, if `negate` is set, when it did not.
+    """
+    negate = False
+
+    def compile_scanned(self, scanned, evaluate):
+        expected = self.expected
+        negate = self.negate
+
+        def evaluate_scanned(entry, node, memo):
+            found = scanned(entry, node, memo)
+            if found is None:
+                return evaluate(entry, node, memo)
+            return (expected in found) is not negate
+        return evaluate_scanned
+
+
+class BeginsWithCondition(FoundCondition):
+    pattern_group = PrefixGroup
 
-class BeginsWithCondition(LogicCondition):
     def compare(self, value):
         return value.startswith(self.expected)
 
 
-class NotBeginsWithCondition(LogicCondition):
+class NotBeginsWithCondition(FoundCondition):
+    pattern_group = PrefixGroup
+    negate = True
+
     def compare(self, value):
         return not value.startswith(self.expected)
 
 
-class ContainsCondition(LogicCondition):
+class ContainsCondition(FoundCondition):
+    pattern_group = SubstringGroup
+
     def compare(self, value):
         return self.expected in value
 
 
-class NotContainsCondition(LogicCondition):
+class NotContainsCondition(FoundCondition):
+    pattern_group = SubstringGroup
+    negate = True
+
     def compare(self, value):
         return self.expected not in value
 
@@ -329,6 +1090,8 @@ class GreaterEqualCondition(LogicCondition):
 
 
 class MatchesRegexCondition(LogicCondition):
+    pattern_group = RegexGroup
+
     def __init__(self, key, expected, **kwargs):
         # Pre-compile the 'expected' value - the regex.
         expected = re.compile(expected)
@@ -337,8 +1100,18 @@ class MatchesRegexCondition(LogicCondition):
     def compare(self, value):
         return self.expected.match(value) is not None
 
+    def compile_scanned(self, scanned, evaluate):
+        def evaluate_scanned(entry, node, memo):
+            # only a value matching none of the group is known not to match
+            if scanned(entry, node, memo) is False:
+                return False
+            return evaluate(entry, node, memo)
+        return evaluate_scanned
+
 
 class NotMatchesRegexCondition(LogicCondition):
+    pattern_group = RegexGroup
+
     def __init__(self, key, expected, **kwargs):
         # Pre-compile the 'expected' value - the regex.
         expected = re.compile(expected)
@@ -347,6 +1120,13 @@ class NotMatchesRegexCondition(LogicCondition):
     def compare(self, value):
         return self.expected.match(value) is None
 
+    def compile_scanned(self, scanned, evaluate):
+        def evaluate_scanned(entry, node, memo):
+            if scanned(entry, node, memo) is False:
+                return True
+            return evaluate(entry, node, memo)
+        return evaluate_scanned
+
 
 # Needs to go at the end
 OPERATOR_MAP = {
@@ -39,6 +39,67 @@ class Config(object):
     DOORMAN_PACK_DELIMITER = '/'
     DOORMAN_MINIMUM_OSQUERY_LOG_LEVEL = 0
 
+    # How result logs received on the /log endpoint are written to the
+    # database. 'orm' builds a ResultLog object per row, while 'copy'
+    # streams the rows straight into PostgreSQL using COPY ... FROM STDIN,
+    # which is considerably cheaper for large or frequent batches. 'copy'
+    # is also used for results received on /distributed/write.
+    DOORMAN_RESULT_LOG_INGESTION = 'orm'
+
+    # When enabled, status and result logs are validated and queued in
+    # memory, and the /log endpoint returns without waiting on the database.
+    # A background thread writes queued logs from many nodes in a single
+    # transaction, either every FLUSH_INTERVAL seconds or once BATCH_SIZE
+    # payloads are waiting. If the queue stays full for PUT_TIMEOUT seconds,
+    # the request falls back to writing synchronously. Queued logs are
+    # flushed when the process exits, but may be lost if it is killed.
+    DOORMAN_INGEST_BUFFER_ENABLED = False
+    DOORMAN_INGEST_BUFFER_MAX_SIZE = 10000
+    DOORMAN_INGEST_BUFFER_BATCH_SIZE = 500
+    DOORMAN_INGEST_BUFFER_FLUSH_INTERVAL = 1.0
+    DOORMAN_INGEST_BUFFER_PUT_TIMEOUT = 5.0
+
+    # Cache nodes by node_key in memory, so authenticating an osquery
+    # request does not need a database query. Changes made through the
+    # manager (deactivating or re-tagging a node) invalidate the cache in
+    # the same process; any other process picks them up once the TTL (in
+    # seconds) has expired.
+    DOORMAN_NODE_CACHE_ENABLED = False
+    DOORMAN_NODE_CACHE_TTL = 60
+    DOORMAN_NODE_CACHE_MAX_SIZE = 50000
+
+    # Keep node check-ins (last_checkin, last_ip) in memory and write them
+    # in batches every so many seconds, instead of updating the node row on
+    # every osquery request. Set to 0 to write check-ins as they happen.
+    DOORMAN_CHECKIN_COALESCE_INTERVAL = 0
+
+    # Remember which nodes have distributed queries waiting for them, so a
+    # distributed read from an idle node does not query the database for
+    # tasks. One of None (disabled), 'memory' (only when the manager and
+    # the osquery API are served by the same process) or 'redis'. Nodes
+    # with new tasks in the database are re-marked every SYNC_INTERVAL
+    # seconds. Enable the node cache and check-in coalescing as well to
+    # keep idle reads off the database entirely.
+    DOORMAN_PENDING_WORK_BACKEND = None
+    DOORMAN_PENDING_WORK_REDIS_URL = 'redis://localhost:6379/0'
+    DOORMAN_PENDING_WORK_REDIS_KEY = 'doorman:pending_work'
+    DOORMAN_PENDING_WORK_SYNC_INTERVAL = 300
+
+    # The largest request body, in bytes, that will be accepted from osquery
+    # once decompressed. Compressed bodies are inflated incrementally and
+    # rejected as soon as they exceed this size.
+    DOORMAN_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+    # Cache the osquery configuration served to each distinct set of tags,
+    # rather than assembling it from the database on every request. Changes
+    # made through the manager invalidate the cache in every process.
+    DOORMAN_CONFIG_CACHE_ENABLED = False
+    DOORMAN_CONFIG_CACHE_MAX_SIZE = 1000
+
+    # How often, in seconds, workers check whether any rule has been added,
+    # changed or deleted through the manager, and if so reload the rules.
+    DOORMAN_RULES_RELOAD_INTERVAL = 10
+
     DOORMAN_ENROLL_DEFAULT_TAGS = [
     ]
 
@@ -67,6 +128,37 @@ class Config(object):
     CELERY_RESULT_SERIALIZER = 'djson'
     CELERY_TASK_SERIALIZER = 'djson'
 
+    # Deliver each alert from its own Celery task, rather than as part of
+    # the task evaluating rules, so that a slow alerter never holds up rule
+    # evaluation. The alerts of each alerter are sent to their own queue,
+    # named by the prefix and the alerter's name (e.g., 'alerts.email'); run
+    # workers for those queues with the concurrency each alerter should
+    # have, e.g. celery worker -A doorman.worker:celery -Q alerts.email -c 2
+    # A delivery is abandoned once it has run for TIME_LIMIT seconds, and
+    # failed deliveries are retried up to MAX_RETRIES times, after
+    # RETRY_BACKOFF seconds, doubling after every attempt. Digests (see
+    # the alerters, below) that fail to send are retried in the same way,
+    # whether or not dispatch is enabled.
+    DOORMAN_ALERT_DISPATCH_ENABLED = False
+    DOORMAN_ALERT_QUEUE_PREFIX = 'alerts.'
+    DOORMAN_ALERT_TIME_LIMIT = 60
+    DOORMAN_ALERT_MAX_RETRIES = 5
+    DOORMAN_ALERT_RETRY_BACKOFF = 30
+
+    # Suppress repeated alerts. Once an alert has been delivered for a rule
+    # and node, further alerts for the same rule and node are suppressed
+    # for WINDOW seconds, and the next alert delivered after that says how
+    # many were. KEY_COLUMNS maps a rule's name to the columns whose values
+    # must also be the same for an alert to be suppressed, e.g.
+    # {'Unsigned binaries': ['path']}. One of None (disabled), 'memory'
+    # (throttled per process, for at most MAX_SIZE keys) or 'redis'.
+    DOORMAN_ALERT_THROTTLE_BACKEND = None
+    DOORMAN_ALERT_THROTTLE_WINDOW = 300
+    DOORMAN_ALERT_THROTTLE_KEY_COLUMNS = {}
+    DOORMAN_ALERT_THROTTLE_MAX_SIZE = 100000
+    DOORMAN_ALERT_THROTTLE_REDIS_URL = 'redis://localhost:6379/0'
+    DOORMAN_ALERT_THROTTLE_REDIS_PREFIX = 'doorman:alert_throttle:'
+
     GRAPHITE_ENABLED = False
     # GRAPHITE_HOST = "localhost"
     # GRAPHITE_PORT = 2003
@@ -107,7 +199,24 @@ class Config(object):
 
         #     # Optional
         #     'client_url': 'https://doorman.domain.com',
-        #     'key_format': 'doorman-security-{count}',
+        #     # {count}, {uuid} and {rule_id} are available; {count} restarts
+        #     # with every worker, so prefer {uuid}, or {rule_id} to group
+        #     # alerts for a rule into one incident.
+        #     'key_format': 'doorman-security-{uuid}',
+        #     # Trigger one event per rule for up to 'max_size' alerts
+        #     # within 'interval' seconds.
+        #     'digest': {'interval': 60, 'max_size': 100},
+        #     # Connect and read timeouts, in seconds, connections kept
+        #     # alive, and concurrent requests; after 'failure_threshold'
+        #     # failed requests in a row, alerts fail without a request
+        #     # for 'reset_timeout' seconds.
+        #     'http': {
+        #         'timeout': [3.05, 10],
+        #         'pool_maxsize': 10,
+        #         'max_concurrency': 10,
+        #         'failure_threshold': 5,
+        #         'reset_timeout': 30,
+        #     },
         # }),
 
         # 'email': ('doorman.plugins.alerters.emailer.EmailAlerter', {
@@ -121,10 +230,17 @@ class Config(object):
         #     'subject_template': '',
         #     'message_template': '',
 
+        #     # Send one email per rule for up to 'max_size' alerts within
+        #     # 'interval' seconds, with the digest templates.
+        #     'digest': {'interval': 60, 'max_size': 100},
+        #     'digest_subject_template': '',
+        #     'digest_message_template': '',
         # }),
 
         # 'sentry': ('doorman.plugins.alerters.sentry.SentryAlerter', {
         #     'dsn': 'https://<key>:<secret>@app.getsentry.com/<project>',
+        #     # As for PagerDuty, above.
+        #     'http': {'timeout': [3.05, 10], 'failure_threshold': 5},
         # })
     }
 
@@ -267,6 +383,9 @@ class TestConfig(Config):
     ]
     DOORMAN_UNIQUE_HOST_ID = False
 
+    # check for rule changes on every result log
+    DOORMAN_RULES_RELOAD_INTERVAL = 0
+
     GRAPHITE_ENABLED = False
 
     DOORMAN_AUTH_METHOD = None
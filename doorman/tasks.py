@@ -20,6 +20,73 @@ def learn_from_result(result, node):
     return
 
 
+@celery.task(bind=True, ignore_result=True)
+def dispatch_alert(self, alerter, node, rule_id, result, suppressed=0):
+    from doorman.rules import RuleMatch
+    from doorman.utils import load_match_result
+
+    rule = get_rule(alerter, rule_id)
+    if rule is None:
+        return
+
+    match = RuleMatch(rule=rule, result=load_match_result(result), node=node,
+                      suppressed=suppressed)
+    try:
+        current_app.rule_manager.alerters[alerter].handle_alert(node, match)
+    except Exception as exc:
+        raise retry_dispatch(self, exc)
+
+
+@celery.task(bind=True, ignore_result=True)
+def dispatch_digest(self, alerter, rule_id, matches):
+    """
+    Send a digest of (node, result, suppressed) matches of a rule, that
+    `alerter` could not send itself, retrying as dispatch_alert does.
+    """
+    from doorman.rules import RuleMatch
+    from doorman.utils import load_match_result
+
+    rule = get_rule(alerter, rule_id)
+    if rule is None:
+        return
+
+    matches = [(node, RuleMatch(rule=rule, result=load_match_result(result),
+                                node=node, suppressed=suppressed))
+               for node, result, suppressed in matches]
+    try:
+        current_app.rule_manager.alerters[alerter].send_digest(matches)
+    except Exception as exc:
+        raise retry_dispatch(self, exc)
+
+
+def get_rule(alerter, rule_id):
+    rule_manager = current_app.rule_manager
+    rule_manager.load_rules()
+
+    rule = rule_manager.rules.get(rule_id)
+    if rule is None:
+        # The rule may be newer than our rules, if they were loaded less
+        # than DOORMAN_RULES_RELOAD_INTERVAL seconds ago.
+        rule_manager.load_rules(force=True)
+        rule = rule_manager.rules.get(rule_id)
+
+    if rule is None:
+        current_app.logger.warning("Dropping %s alert for rule %s, which "
+                                   "no longer exists", alerter, rule_id)
+    return rule
+
+
+def retry_dispatch(task, exc):
+    # This includes SoftTimeLimitExceeded, for a delivery taking longer
+    # than DOORMAN_ALERT_TIME_LIMIT.
+    config = current_app.config
+    return task.retry(
+        exc=exc,
+        countdown=config['DOORMAN_ALERT_RETRY_BACKOFF'] * 2 ** task.request.retries,
+        max_retries=config['DOORMAN_ALERT_MAX_RETRIES'],
+    )
+
+
 @celery.task()
 def example_task(one, two):
     print('Adding {0} and {1}'.format(one, two))
@@ -3,14 +3,20 @@ from collections import namedtuple
 from operator import itemgetter
 from os.path import basename, join, splitext
 import datetime as dt
+import hashlib
+import itertools
 import json
 import pkg_resources
 import sqlite3
 import string
 import threading
+import zlib
 
 import six
 from flask import current_app, flash
+from sqlalchemy import Text, cast, func, literal, or_, select, text
+from sqlalchemy.dialects.postgresql import UUID
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from doorman.database import db
 from doorman.models import ResultLog
@@ -18,6 +24,8 @@ from doorman.models import ResultLog
 
 Field = namedtuple('Field', ['name', 'action', 'columns', 'timestamp'])
 
+RESULT_LOG_COLUMNS = ('name', 'timestamp', 'action', 'columns', 'node_id')
+
 
 # Read DDL statements from our package
 schema = pkg_resources.resource_string('doorman', join('resources', 'osquery_schema.sql'))
@@ -29,6 +37,44 @@ schema = [x for x in schema.strip().split('\n') if not x.startswith('--')]
 osquery_mock_db = threading.local()
 
 
+CONFIG_GENERATION = 'config'
+RULES_GENERATION = 'rules'
+
+
+def get_configuration_json(node):
+    '''
+    Returns the osquery configuration of a node as JSON, ready to be sent,
+    along with an ETag for it, from the configuration cache where possible.
+    '''
+    from doorman.extensions import config_cache
+
+    if not config_cache.enabled:
+        return dump_configuration(node.get_config())
+
+    tags = tuple(sorted(tag.value for tag in node.tags))
+    generation = get_generation(CONFIG_GENERATION)
+
+    config = config_cache.get(tags, generation)
+    if config is None:
+        config = config_cache.set(tags, generation,
+                                  dump_configuration(node.get_config()))
+    return config
+
+
+def dump_configuration(config):
+    # keys are sorted so that the same configuration always results in the
+    # same body, and so the same ETag, in every process
+    body = json.dumps(dict(config, node_invalid=False),
+                      sort_keys=True).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+
+def get_generation(name):
+    from doorman.models import Generation
+    return db.session.query(Generation.value) \
+        .filter(Generation.name == name).scalar() or 0
+
+
 def assemble_configuration(node):
     configuration = {}
     configuration['options'] = assemble_options(node)
@@ -79,27 +125,119 @@ def assemble_distributed_queries(node):
     distributed query to PENDING, however will not commit the change.
     It is the responsibility of the caller to commit or rollback on the
     current database session.
+
+    Tasks are claimed with a single UPDATE ... RETURNING, so a node with
+    nothing to do costs one probe of the (node_id, status) index.
     '''
-    from doorman.models import DistributedQueryTask
+    from doorman.models import DistributedQuery, DistributedQueryTask
     now = dt.datetime.utcnow()
 
-    queries = {}
-    for task in node.distributed_queries.filter(
-        DistributedQueryTask.status == DistributedQueryTask.NEW):
+    task = DistributedQueryTask.__table__
+    query = DistributedQuery.__table__
+
+    # don't commit until we're as sure as we possibly can be that it's
+    # been received by the osqueryd client. unfortunately, there are no
+    # guarantees though.
+    claimed = db.session.execute(
+        task.update()
+        .where(task.c.node_id == node.id)
+        .where(task.c.status == DistributedQueryTask.NEW)
+        .where(task.c.distributed_query_id == query.c.id)
+        .where(or_(query.c.not_before == None, query.c.not_before <= now))
+        .values(status=DistributedQueryTask.PENDING, timestamp=now)
+        .returning(task.c.guid, query.c.sql)
+    )
 
-        if task.distributed_query.not_before > now:
-            continue
+    return dict((guid, sql) for guid, sql in claimed)
+
+
+def create_distributed_query_tasks(query, node_keys=None, tags=None):
+    '''
+    Create a NEW task of a distributed query for every node with one of
+    `node_keys`, or one of `tags`, or for every node if neither is given,
+    using a single INSERT ... SELECT. A node matching more than one of
+    these is only given one task, and guids are generated by the database.
+    This will not commit.
+
+    :returns: the ids of the nodes the query was assigned to.
+    '''
+    from doorman.models import DistributedQueryTask, Node, Tag
+
+    criteria = []
+    if node_keys:
+        criteria.append(Node.node_key.in_(node_keys))
+    if tags:
+        criteria.append(Node.tags.any(Tag.value.in_(tags)))
+
+    # a random, uuid-formatted guid, without relying on any extension
+    guid = cast(cast(func.md5(
+        cast(func.random(), Text) +
+        cast(func.clock_timestamp(), Text) +
+        cast(Node.id, Text)
+    ), UUID), Text)
+
+    nodes = select([
+        guid,
+        literal(DistributedQueryTask.NEW),
+        literal(query.id),
+        Node.id,
+    ])
+
+    if criteria:
+        nodes = nodes.where(or_(*criteria))
+
+    task = DistributedQueryTask.__table__
+    created = db.session.execute(
+        task.insert()
+        .from_select(['guid', 'status', 'distributed_query_id', 'node_id'], nodes)
+        .returning(task.c.node_id)
+    )
+
+    return [node_id for node_id, in created]
+
+
+def update_checkin(node):
+    '''
+    Write a node's last_checkin and last_ip, or hand them to the check-in
+    coalescer when it is enabled. This will not commit; it is the
+    responsibility of the caller to commit or rollback on the current
+    database session.
+    '''
+    from doorman.extensions import checkin_coalescer
+
+    if checkin_coalescer.record(node):
+        return
 
-        queries[task.guid] = task.distributed_query.sql
-        task.update(status=DistributedQueryTask.PENDING,
-                    timestamp=dt.datetime.utcnow(),
-                    commit=False)
+    write_checkins({node.id: (node.last_checkin, node.last_ip)})
 
-        # add this query to the session, but don't commit until we're
-        # as sure as we possibly can be that it's been received by the
-        # osqueryd client. unfortunately, there are no guarantees though.
-        db.session.add(task)
-    return queries
+
+def write_checkins(checkins, batch_size=1000):
+    '''
+    Write a mapping of node id to (last_checkin, last_ip), using one
+    UPDATE ... FROM (VALUES ...) statement per `batch_size` nodes. A
+    check-in older than the one already stored for a node is ignored.
+    This will not commit.
+    '''
+    items = sorted(checkins.items())
+
+    for offset in range(0, len(items), batch_size):
+        values = []
+        params = {}
+
+        for i, (node_id, (last_checkin, last_ip)) in enumerate(
+                items[offset:offset + batch_size]):
+            values.append('(:id_{0}, CAST(:checkin_{0} AS timestamp), '
+                          'CAST(:ip_{0} AS inet))'.format(i))
+            params['id_{0}'.format(i)] = node_id
+            params['checkin_{0}'.format(i)] = last_checkin
+            params['ip_{0}'.format(i)] = last_ip
+
+        db.session.execute(text(
+            'UPDATE node SET last_checkin = v.last_checkin, last_ip = v.last_ip '
+            'FROM (VALUES {0}) AS v (id, last_checkin, last_ip) '
+            'WHERE node.id = v.id AND (node.last_checkin IS NULL '
+            'OR node.last_checkin <= v.last_checkin)'.format(', '.join(values))
+        ), params)
 
 
 def create_query_pack_from_upload(upload):
@@ -174,9 +312,53 @@ def create_query_pack_from_upload(upload):
     return pack
 
 
+def get_last_checkin(node):
+    '''
+    Returns the most recent check-in of a node, including any check-in
+    that the check-in coalescer has yet to write to the database.
+    '''
+    from doorman.extensions import checkin_coalescer
+
+    pending = checkin_coalescer.get(node.id)
+    if pending is None or (node.last_checkin and node.last_checkin > pending[0]):
+        return node.last_checkin
+    return pending[0]
+
+
+def inflate_gzip(stream, max_size, chunk_size=64 * 1024):
+    '''
+    Decompress a gzip stream incrementally, a chunk at a time, so that at
+    most `max_size` bytes are ever inflated; a larger payload raises
+    RequestEntityTooLarge rather than exhausting the worker's memory.
+    '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    size = 0
+
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        while chunk:
+            # ask for one byte more than allowed, to detect an oversized
+            # payload without inflating any more of it
+            data = decompressor.decompress(chunk, max_size - size + 1)
+            size += len(data)
+            if size > max_size:
+                raise RequestEntityTooLarge()
+
+            chunks.append(data)
+            chunk = decompressor.unconsumed_tail
+
+    data = decompressor.flush()
+    if size + len(data) > max_size:
+        raise RequestEntityTooLarge()
+
+    chunks.append(data)
+    return b''.join(chunks)
+
+
 def get_node_health(node):
     checkin_interval = current_app.config['DOORMAN_CHECKIN_INTERVAL']
-    if (dt.datetime.utcnow() - node.last_checkin).total_seconds() > checkin_interval:
+    last_checkin = get_last_checkin(node)
+    if (dt.datetime.utcnow() - last_checkin).total_seconds() > checkin_interval:
         return u'danger'
     else:
         return ''
@@ -276,7 +458,8 @@ def validate_osquery_query(query):
 def learn_from_result(result, node):
     from doorman.models import Node
 
-    if not result['data']:
+    # `result` is either a result log, or its rows (see ResultBatch)
+    if not (result if isinstance(result, list) else result['data']):
         return
 
     capture_columns = set(
@@ -328,21 +511,299 @@ def process_result(result, node):
                         node_id=node.id)
 
 
+def copy_result_logs(result, node):
+    '''
+    Write the rows of a result log straight into the result_log table
+    using PostgreSQL's COPY ... FROM STDIN, without constructing a
+    ResultLog object per row. Rows are written on the current session's
+    connection, so they are committed (or rolled back) along with the
+    rest of the session.
+    '''
+    if not result['data']:
+        current_app.logger.error("No results to process from %s", node)
+        return 0
+
+    return copy_rows(ResultLog.__table__, RESULT_LOG_COLUMNS,
+                     result_log_rows(result, node.id))
+
+
+def result_log_rows(result, node_id):
+    '''
+    Flatten a result log into (name, timestamp, action, columns, node_id)
+    tuples, matching the order of RESULT_LOG_COLUMNS.
+    '''
+    for name, action, columns, timestamp, in extract_results(result):
+        yield (name, timestamp, action, columns, node_id)
+
+
+DISTRIBUTED_QUERY_RESULT_COLUMNS = ('columns', 'timestamp',
+                                    'distributed_query_task_id',
+                                    'distributed_query_id')
+
+
+def write_distributed_query_results(rows):
+    '''
+    Write (columns, timestamp, distributed_query_task_id,
+    distributed_query_id) tuples to the distributed_query_result table,
+    with COPY when DOORMAN_RESULT_LOG_INGESTION is 'copy', or else a single
+    executemany INSERT, without constructing an ORM object per row. This
+    will not commit.
+
+    :returns: the number of rows written.
+    '''
+    from doorman.models import DistributedQueryResult
+
+    if not rows:
+        return 0
+
+    table = DistributedQueryResult.__table__
+
+    if current_app.config['DOORMAN_RESULT_LOG_INGESTION'] == 'copy':
+        # columns is a JSONB column, so must always be encoded, even when
+        # osquery sent us a bare string
+        return copy_rows(table, DISTRIBUTED_QUERY_RESULT_COLUMNS, (
+            (json.dumps(row[0]),) + row[1:] for row in rows))
+
+    db.session.execute(table.insert(), [
+        dict(zip(DISTRIBUTED_QUERY_RESULT_COLUMNS, row)) for row in rows])
+    return len(rows)
+
+
+def copy_rows(table, columns, rows):
+    '''
+    Stream an iterable of row tuples into `table` with COPY ... FROM STDIN.
+    Rows are formatted lazily as PostgreSQL reads from the stream, so the
+    whole batch is never held in memory as a single buffer.
+
+    :returns: the number of rows written.
+    '''
+    stream = CopyStream(rows)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY {0} ({1}) FROM STDIN'.format(table.name, ', '.join(columns)),
+            stream
+        )
+    finally:
+        cursor.close()
+    return stream.count
+
+
+def copy_escape(value):
+    '''
+    Format a single value for PostgreSQL's COPY text format.
+    '''
+    if value is None:
+        return u'\\N'
+    elif isinstance(value, dt.datetime):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif not isinstance(value, six.string_types):
+        value = six.text_type(value)
+
+    return value.replace(u'\\', u'\\\\') \
+                .replace(u'\t', u'\\t') \
+                .replace(u'\n', u'\\n') \
+                .replace(u'\r', u'\\r')
+
+
+class CopyStream(object):
+    '''
+    A minimal, read-only file-like object that formats rows for COPY
+    on demand, as psycopg2's `copy_expert` asks for more data.
+    '''
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+        self.count = 0
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+
+            line = u'\t'.join(copy_escape(v) for v in row) + u'\n'
+            line = line.encode('utf-8')
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+
+        data = b''.join(chunks)
+        if size < 0:
+            self.buffer = b''
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def write_pending_logs(pending):
+    '''
+    Write a batch of buffered /log payloads (see `IngestBuffer`), possibly
+    from many different nodes, to the current database session. This will
+    not commit; it is the responsibility of the caller to commit or
+    rollback on the current database session.
+    '''
+    from doorman.models import StatusLog
+
+    results = []
+    checkins = {}
+
+    for item in pending:
+        if item.log_type == 'status':
+            for status in item.data:
+                db.session.add(StatusLog(node_id=item.node_id, **status))
+        elif item.log_type == 'result' and item.data['data']:
+            results.append(result_log_rows(item.data, item.node_id))
+
+        # keep only the most recent check-in for each node
+        checkin = checkins.get(item.node_id)
+        if checkin is None or checkin[0] < item.last_checkin:
+            checkins[item.node_id] = (item.last_checkin, item.last_ip)
+
+    rows = itertools.chain.from_iterable(results)
+    if current_app.config['DOORMAN_RESULT_LOG_INGESTION'] == 'copy':
+        copy_rows(ResultLog.__table__, RESULT_LOG_COLUMNS, rows)
+    else:
+        db.session.bulk_insert_mappings(
+            ResultLog, [dict(zip(RESULT_LOG_COLUMNS, row)) for row in rows])
+
+    write_checkins(checkins)
+
+
+MONTHS = dict((month, i) for i, month in enumerate((
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
+CALENDAR_TIME_CACHE_SIZE = 1024
+
+_calendar_times = {}
+
+
+def parse_calendar_time(value):
+    """
+    Parse an osquery calendarTime, e.g., 'Mon Jul 18 09:59:06 2016 UTC'.
+
+    This is equivalent to strptime(value, '%a %b %d %H:%M:%S %Y UTC'), but
+    does not depend on the locale, and remembers recently seen values, as
+    the entries of a batch mostly share a handful of distinct timestamps.
+    """
+    timestamp = _calendar_times.get(value)
+    if timestamp is not None:
+        return timestamp
+
+    try:
+        _, month, day, clock, year, zone = value.split()
+        hour, minute, second = clock.split(':')
+        if zone != 'UTC':
+            raise ValueError
+        timestamp = dt.datetime(int(year), MONTHS[month], int(day),
+                                int(hour), int(minute), int(second))
+    except (KeyError, ValueError):
+        raise ValueError("calendarTime {0!r} does not match format "
+                         "'%a %b %d %H:%M:%S %Y UTC'".format(value))
+
+    if len(_calendar_times) >= CALENDAR_TIME_CACHE_SIZE:
+        _calendar_times.clear()
+
+    _calendar_times[value] = timestamp
+    return timestamp
+
+
+class ResultBatch(dict):
+    """
+    A result log as received from osquery, which is converted into Fields
+    at most once, however many times it is passed to extract_results. This
+    lets the database writer, the log plugins and the rule manager share
+    the work of normalizing a single request.
+    """
+    _fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = tuple(_extract_results(self))
+        return self._fields
+
+    def validate(self):
+        """
+        Extract the Fields now, raising ValueError if the result log is
+        malformed, e.g. an entry is missing its name or calendarTime.
+        """
+        try:
+            self.fields
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError("Invalid result log: {0!r}".format(e))
+
+    def rows(self):
+        """
+        Returns the Fields as [name, action, columns, timestamp] rows, to
+        send to the Celery worker. Timestamps are sent as UTC strings, as
+        the task serializer would convert datetimes through local time.
+        """
+        return [[name, action, columns, timestamp.strftime(ROW_TIMESTAMP_FORMAT)]
+                for name, action, columns, timestamp in self.fields]
+
+
+ROW_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def dump_match_result(result):
+    """
+    Returns the result of a rule match, with its timestamp as a UTC string,
+    to send to a Celery task; see ResultBatch.rows and load_match_result.
+    """
+    return dict(result,
+                timestamp=result['timestamp'].strftime(ROW_TIMESTAMP_FORMAT))
+
+
+def load_match_result(result):
+    return dict(result, timestamp=dt.datetime.strptime(
+        result['timestamp'], ROW_TIMESTAMP_FORMAT))
+
+
 def extract_results(result):
     """
     extract_results will convert the incoming log data into a series of Fields,
     normalizing and/or aggregating both batch and event format into batch
     format, which is used throughout the rest of doorman.
+
+    `result` may also be a ResultBatch, whose Fields are only extracted once,
+    or a list of its rows, as sent to the Celery worker.
     """
+    if isinstance(result, ResultBatch):
+        return iter(result.fields)
+    elif isinstance(result, list):
+        return _load_rows(result)
+    return _extract_results(result)
+
+
+def _load_rows(rows):
+    timestamps = {}
+    for name, action, columns, timestamp in rows:
+        parsed = timestamps.get(timestamp)
+        if parsed is None:
+            parsed = timestamps[timestamp] = dt.datetime.strptime(
+                timestamp, ROW_TIMESTAMP_FORMAT)
+        yield Field(name=name,
+                    action=action,
+                    columns=columns,
+                    timestamp=parsed)
+
+
+def _extract_results(result):
     if not result['data']:
         return
 
-    timefmt = '%a %b %d %H:%M:%S %Y UTC'
-    strptime = dt.datetime.strptime
-
     for entry in result['data']:
         name = entry['name']
-        timestamp = strptime(entry['calendarTime'], timefmt)
+        timestamp = parse_calendar_time(entry['calendarTime'])
 
         if 'columns' in entry:
             yield Field(name=name,
@@ -0,0 +1,35 @@
+"""Add generation table
+
+Revision ID: 7d2c1e4c4f5b
+Revises: 236318ee3d3e
+Create Date: 2016-07-05 14:21:37.410562
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2c1e4c4f5b'
+down_revision = '236318ee3d3e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    generation = op.create_table('generation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+
+    # Seed the counters, so that the first writers to bump one don't race
+    # to insert its row.
+    op.bulk_insert(generation, [
+        {'name': 'config', 'value': 0},
+        {'name': 'rules', 'value': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('generation')
@@ -0,0 +1,23 @@
+"""Add (node_id, status) index to distributed_query_task
+
+Revision ID: a6e3b15d5c3d
+Revises: 7d2c1e4c4f5b
+Create Date: 2016-07-12 10:03:44.581122
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a6e3b15d5c3d'
+down_revision = '7d2c1e4c4f5b'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('idx__distributed_query_task__node_id__status',
+                    'distributed_query_task', ['node_id', 'status'])
+
+
+def downgrade():
+    op.drop_index('idx__distributed_query_task__node_id__status',
+                  table_name='distributed_query_task')
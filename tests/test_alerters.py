@@ -2,18 +2,147 @@
 from collections import namedtuple
 import datetime as dt
 import json
+import threading
+import time
 import mock
+import pytest
 import raven
+from raven.exceptions import APIError, RateLimited
+import requests
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
 
 from doorman.rules import RuleMatch
 from doorman.plugins.alerters.emailer import EmailAlerter
 from doorman.plugins.alerters.pagerduty import PagerDutyAlerter
 from doorman.plugins.alerters.sentry import SentryAlerter
+from doorman.plugins.alerters.session import CircuitOpenError, HTTPSession
 
 
 MockResponse = namedtuple('MockResponse', ['ok', 'content'])
 
 
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # How the stub responds, and what it has seen.
+    status = 200
+    headers = {}
+    delay = 0
+    connections = 0
+    requests = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, body))
+        time.sleep(self.server.delay)
+
+        self.send_response(self.server.status)
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.yield_fixture
+def stub():
+    """ A local HTTP server, to which alerters can send their requests. """
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    server.url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestHTTPSession:
+
+    def test_will_reuse_connections(self, stub):
+        session = HTTPSession()
+        for i in range(3):
+            resp = session.post(stub.url, data='{0}'.format(i))
+            assert resp.status_code == 200
+
+        assert [body for _, body in stub.requests] == [b'0', b'1', b'2']
+        assert stub.connections == 1
+
+    def test_will_time_out(self, stub):
+        stub.delay = 0.5
+        session = HTTPSession(timeout=[1, 0.1])
+
+        with pytest.raises(requests.Timeout):
+            session.post(stub.url, data='foo')
+
+    def test_will_open_circuit(self, stub):
+        stub.status = 500
+        session = HTTPSession(failure_threshold=2, reset_timeout=0.2)
+
+        for _ in range(2):
+            assert session.post(stub.url).status_code == 500
+
+        with pytest.raises(CircuitOpenError):
+            session.post(stub.url)
+        assert len(stub.requests) == 2
+
+        # once the reset timeout has passed, a request is let through, and
+        # closes the circuit if it succeeds
+        time.sleep(0.2)
+        stub.status = 200
+        assert session.post(stub.url).status_code == 200
+        assert session.post(stub.url).status_code == 200
+        assert len(stub.requests) == 4
+
+    def test_will_reopen_circuit(self, stub):
+        stub.status = 500
+        session = HTTPSession(failure_threshold=1, reset_timeout=0.2)
+
+        assert session.post(stub.url).status_code == 500
+        time.sleep(0.2)
+        assert session.post(stub.url).status_code == 500
+
+        with pytest.raises(CircuitOpenError):
+            session.post(stub.url)
+        assert len(stub.requests) == 2
+
+    def test_will_count_rate_limiting(self, stub):
+        stub.status = 429
+        session = HTTPSession(failure_threshold=1)
+
+        assert session.post(stub.url).status_code == 429
+        with pytest.raises(CircuitOpenError):
+            session.post(stub.url)
+
+    def test_will_count_connection_errors(self, stub):
+        url = stub.url
+        stub.shutdown()
+        stub.server_close()
+
+        session = HTTPSession(failure_threshold=1)
+        with pytest.raises(requests.ConnectionError):
+            session.post(url)
+        with pytest.raises(CircuitOpenError):
+            session.post(url)
+
+
 class TestPagerDutyAlerter:
 
     def setup_method(self, _method):
@@ -36,7 +165,7 @@ class TestPagerDutyAlerter:
         )
 
         resp = MockResponse(ok=True, content='blah')
-        with mock.patch('requests.post', return_value=resp) as pmock:
+        with mock.patch.object(HTTPSession, 'post', return_value=resp) as pmock:
             alerter = PagerDutyAlerter(self.config)
             alerter.handle_alert(node.to_dict(), match)
 
@@ -62,7 +191,7 @@ class TestPagerDutyAlerter:
         )
 
         resp = MockResponse(ok=True, content='blah')
-        with mock.patch('requests.post', return_value=resp) as pmock:
+        with mock.patch.object(HTTPSession, 'post', return_value=resp) as pmock:
             alerter = PagerDutyAlerter(self.config)
             alerter.handle_alert(node.to_dict(), match)
 
@@ -72,6 +201,104 @@ class TestPagerDutyAlerter:
         data = json.loads(kwargs['data'])
         assert data['service_key'] == self.service_key
 
+    def test_will_format_incident_key(self, node, rule):
+        match = RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': 'bar',
+                'columns': {'boo': 'baz', 'kung': 'bloo'},
+            }
+        )
+
+        config = dict(self.config, key_format='doorman-{rule_id}-{uuid}')
+        resp = MockResponse(ok=True, content='blah')
+        with mock.patch.object(HTTPSession, 'post', return_value=resp) as pmock:
+            alerter = PagerDutyAlerter(config)
+            alerter.handle_alert(node.to_dict(), match)
+            alerter.handle_alert(node.to_dict(), match)
+
+        keys = [json.loads(kwargs['data'])['incident_key']
+                for _, kwargs in pmock.call_args_list]
+        assert keys[0].startswith('doorman-{0}-'.format(rule.id))
+        assert keys[0] != keys[1]
+
+    def test_will_send_digest(self, node, rule):
+        matches = [RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': 'bar',
+                'columns': {'boo': 'baz', 'kung': str(i)},
+            }
+        ) for i in range(3)]
+
+        config = dict(self.config, digest={'interval': 60, 'max_size': 2})
+        resp = MockResponse(ok=True, content='blah')
+        with mock.patch.object(HTTPSession, 'post', return_value=resp) as pmock:
+            alerter = PagerDutyAlerter(config)
+            for match in matches:
+                alerter.handle_alert(node.to_dict(), match)
+
+            assert pmock.call_count == 1
+            data = json.loads(pmock.call_args[1]['data'])
+            assert data['description'].startswith('2 matches of')
+            assert [m['match']['kung'] for m in data['details']['matches']] == ['0', '1']
+
+            alerter.digest.flush(force=True)
+            assert pmock.call_count == 2
+            data = json.loads(pmock.call_args[1]['data'])
+            assert [m['match']['kung'] for m in data['details']['matches']] == ['2']
+
+    def test_will_requeue_failed_digest(self, node, rule):
+        matches = [RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': 'bar',
+                'columns': {'boo': 'baz', 'kung': str(i)},
+            }
+        ) for i in range(2)]
+
+        config = dict(self.config, digest={'interval': 60, 'max_size': 2})
+        error = CircuitOpenError('circuit open')
+        with mock.patch.object(HTTPSession, 'post', side_effect=error):
+            alerter = PagerDutyAlerter(config)
+            alerter.digest.requeue = mock.Mock()
+            for match in matches:
+                alerter.handle_alert(node.to_dict(), match)
+
+        alerter.digest.requeue.assert_called_once_with(
+            [(node.to_dict(), match) for match in matches])
+
+    def test_will_post_to_service(self, node, rule, stub):
+        match = RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': 'bar',
+                'columns': {'boo': 'baz', 'kung': 'bloo'},
+            }
+        )
+
+        config = dict(self.config, url=stub.url + 'create_event.json',
+                      http={'timeout': [1, 1]})
+        alerter = PagerDutyAlerter(config)
+        alerter.handle_alert(node.to_dict(), match)
+        alerter.handle_alert(node.to_dict(), match)
+
+        assert [path for path, _ in stub.requests] == ['/create_event.json'] * 2
+        assert json.loads(stub.requests[0][1].decode('utf-8'))['service_key'] == self.service_key
+        assert stub.connections == 1
+
 
 class TestEmailerAlerter:
     def setup_method(self, _method):
@@ -112,6 +339,36 @@ class TestEmailerAlerter:
         alerter = EmailAlerter(self.config)
         alerter.handle_alert(node.to_dict(), match)
 
+    def test_will_email_digest(self, node, rule, testapp):
+        from flask_mail import email_dispatched
+
+        matches = [RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': 'bar',
+                'columns': {'boo': 'baz', 'kung': 'bloo-{0}'.format(i)},
+            }
+        ) for i in range(2)]
+
+        messages = []
+
+        @email_dispatched.connect
+        def verify(message, app):
+            messages.append(message)
+
+        config = dict(self.config, digest={'interval': 60, 'max_size': 2})
+        alerter = EmailAlerter(config)
+        for match in matches:
+            alerter.handle_alert(node.to_dict(), match)
+
+        assert len(messages) == 1
+        assert messages[0].subject == '[Doorman Test] 2 alerts: {0}'.format(rule.name)
+        assert 'bloo-0' in messages[0].body
+        assert 'bloo-1' in messages[0].body
+
 
 class TestSentryAlerter:
 
@@ -143,3 +400,52 @@ class TestSentryAlerter:
             match.result['columns'],
             **node.to_dict()
         ).rstrip()
+
+    def test_will_send_through_session(self, node, rule, testapp, stub):
+        match = RuleMatch(
+            rule=rule,
+            node=node.to_dict(),
+            result={
+                'name': 'foo',
+                'action': 'added',
+                'timestamp': dt.datetime.utcnow(),
+                'columns': {'boo': 'baz', 'kung': 'bloo'},
+            }
+        )
+
+        config = {
+            'dsn': stub.url.replace('http://', 'http://key:secret@') + '1',
+            'http': {'timeout': [1, 1]},
+        }
+        alerter = SentryAlerter(config)
+        alerter.handle_alert(node.to_dict(), match)
+
+        # events are sent from raven's worker thread
+        for _ in range(20):
+            if stub.requests:
+                break
+            time.sleep(0.1)
+
+        assert [path for path, _ in stub.requests] == ['/api/1/store/']
+
+    def test_will_back_off_when_rate_limited(self, stub):
+        stub.status = 429
+        stub.headers = {
+            'Retry-After': '30',
+            'X-Sentry-Error': 'Creation of this event was denied due to rate limiting',
+        }
+        config = {
+            'dsn': stub.url.replace('http://', 'http://key:secret@') + '1',
+            'http': {'timeout': [1, 2]},
+        }
+        transport = SentryAlerter(config).client.remote.get_transport()
+
+        with pytest.raises(RateLimited) as excinfo:
+            transport.send(b'{}', {})
+        assert excinfo.value.retry_after == 30
+
+        stub.status = 403
+        stub.headers = {'X-Sentry-Error': 'Invalid api key'}
+        with pytest.raises(APIError) as excinfo:
+            transport.send(b'{}', {})
+        assert excinfo.value.code == 403
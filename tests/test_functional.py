@@ -7,6 +7,8 @@ import gzip
 import io
 import json
 import mock
+import pytest
+import threading
 import time
 
 try:
@@ -19,7 +21,9 @@ from doorman.models import (
     DistributedQuery, DistributedQueryTask, DistributedQueryResult, Rule,
 )
 from doorman.settings import TestConfig
-from doorman.utils import learn_from_result
+from doorman.utils import (
+    RULES_GENERATION, get_generation, get_last_checkin, learn_from_result
+)
 
 from .factories import NodeFactory, PackFactory, QueryFactory, TagFactory
 
@@ -362,6 +366,194 @@ class TestConfiguration:
         assert query.name in node.get_config()['schedule']
         assert not node.get_config()['packs']  # should be an empty {}
 
+    def test_configuration_not_modified(self, node, testapp):
+        resp = testapp.post_json(url_for('api.configuration'), {
+            'node_key': node.node_key})
+        etag = resp.headers['ETag']
+
+        resp = testapp.post_json(url_for('api.configuration'), {
+            'node_key': node.node_key}, headers={'If-None-Match': etag})
+        assert resp.status_int == 304
+        assert not resp.body
+        assert resp.headers['ETag'] == etag
+
+        tag = TagFactory(value='foobar')
+        query = QueryFactory(name='foobar', sql='select * from foobar;')
+        query.tags.append(tag)
+        query.save()
+        node.tags.append(tag)
+        node.save()
+
+        resp = testapp.post_json(url_for('api.configuration'), {
+            'node_key': node.node_key}, headers={'If-None-Match': etag})
+        assert resp.status_int == 200
+        assert resp.headers['ETag'] != etag
+        assert query.name in resp.json['schedule']
+
+
+class TestNodeCache:
+
+    def make_cache(self, app, **config):
+        from doorman.extensions import NodeCache
+
+        config.setdefault('DOORMAN_NODE_CACHE_ENABLED', True)
+        cache = NodeCache()
+        with mock.patch.dict(app.config, config):
+            cache.init_app(app)
+        return cache
+
+    def test_will_not_query_cached_node(self, node, testapp):
+        cache = self.make_cache(testapp.app)
+
+        with mock.patch('doorman.api.node_cache', cache):
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert resp.json['node_invalid'] is False
+
+            with mock.patch.object(Node, 'query') as mock_query:
+                resp = testapp.post_json(url_for('api.configuration'), {
+                    'node_key': node.node_key})
+                assert resp.json['node_invalid'] is False
+                assert not mock_query.filter_by.called
+
+    def test_deactivating_node_invalidates_cache(self, node, testapp):
+        cache = self.make_cache(testapp.app)
+
+        with mock.patch('doorman.api.node_cache', cache), \
+                mock.patch('doorman.manage.views.node_cache', cache):
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert resp.json['node_invalid'] is False
+            assert cache.get(node.node_key).is_active
+
+            resp = testapp.post(url_for('manage.get_node', node_id=node.id), {
+                'is_active': '',
+            })
+            assert cache.get(node.node_key) is None
+
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert resp.json['node_invalid'] is True
+
+    def test_entries_expire(self, node, app):
+        cache = self.make_cache(app, DOORMAN_NODE_CACHE_TTL=-1)
+        cache.set(node.to_record())
+        assert cache.get(node.node_key) is None
+
+    def test_least_recently_used_entries_are_evicted(self, db, app):
+        cache = self.make_cache(app, DOORMAN_NODE_CACHE_MAX_SIZE=2)
+        nodes = [NodeFactory(host_identifier=h) for h in ('one', 'two', 'three')]
+        db.session.commit()
+        one, two, three = [n.to_record() for n in nodes]
+
+        cache.set(one)
+        cache.set(two)
+        assert cache.get(one.node_key) == one
+
+        cache.set(three)
+        assert cache.get(one.node_key) == one
+        assert cache.get(two.node_key) is None
+        assert cache.get(three.node_key) == three
+
+
+class TestConfigCache:
+
+    def make_cache(self, app):
+        from doorman.extensions import ConfigCache
+
+        cache = ConfigCache()
+        with mock.patch.dict(app.config, {'DOORMAN_CONFIG_CACHE_ENABLED': True}):
+            cache.init_app(app)
+        return cache
+
+    def test_configuration_is_served_from_cache(self, node, testapp):
+        cache = self.make_cache(testapp.app)
+
+        with mock.patch('doorman.extensions.config_cache', cache):
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            first_config = resp.json
+
+            with mock.patch('doorman.utils.assemble_configuration') as mock_assemble:
+                resp = testapp.post_json(url_for('api.configuration'), {
+                    'node_key': node.node_key})
+                assert not mock_assemble.called
+                assert resp.json == first_config
+
+    def test_changing_query_tags_invalidates_cache(self, node, testapp):
+        cache = self.make_cache(testapp.app)
+        tag = TagFactory(value='foobar')
+        node.tags.append(tag)
+        node.save()
+        query = QueryFactory(name='foobar', sql='select * from foobar;')
+        query.save()
+
+        with mock.patch('doorman.extensions.config_cache', cache):
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert query.name not in resp.json['schedule']
+
+            testapp.post_json(url_for('manage.tag_query', query_id=query.id),
+                              ['foobar'], xhr=True)
+
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert query.name in resp.json['schedule']
+
+    def test_changing_queries_bumps_generation(self, db, node):
+        from doorman.utils import CONFIG_GENERATION
+
+        query = QueryFactory(name='foobar', sql='select * from foobar;')
+        query.save()
+        generation = get_generation(CONFIG_GENERATION)
+
+        query.update(sql='select * from barbaz;')
+        assert get_generation(CONFIG_GENERATION) == generation + 1
+
+        query.delete()
+        assert get_generation(CONFIG_GENERATION) == generation + 2
+
+    def test_entries_from_older_generations_are_not_served(self, app):
+        cache = self.make_cache(app)
+        cache.set(('foo',), 1, b'{}')
+        assert cache.get(('foo',), 1) == b'{}'
+
+        cache.set(('bar',), 2, b'{}')
+        assert cache.get(('foo',), 1) is None
+        assert cache.get(('foo',), 2) is None
+
+
+class TestCheckinCoalescer:
+
+    def test_checkins_are_written_in_batches(self, db, node, testapp):
+        from doorman.extensions import CheckinCoalescer
+
+        coalescer = CheckinCoalescer()
+        with mock.patch.dict(testapp.app.config, {
+                'DOORMAN_CHECKIN_COALESCE_INTERVAL': 3600}):
+            coalescer.init_app(testapp.app)
+
+        last_checkin = node.last_checkin
+
+        with mock.patch('doorman.extensions.checkin_coalescer', coalescer):
+            resp = testapp.post_json(url_for('api.configuration'), {
+                'node_key': node.node_key})
+            assert resp.json['node_invalid'] is False
+
+            pending = coalescer.get(node.id)
+            assert pending is not None
+            assert pending[0] > last_checkin
+
+            db.session.expire(node)
+            assert node.last_checkin == last_checkin
+            assert get_last_checkin(node) == pending[0]
+
+            coalescer.stop()
+
+            db.session.expire(node)
+            assert node.last_checkin == pending[0]
+            assert coalescer.get(node.id) is None
+
 
 class TestLogging:
 
@@ -459,6 +651,34 @@ class TestLogging:
         assert node.status_logs[0].filename == data['filename']
         assert node.last_ip == '127.0.0.2'
 
+    def test_gzipped_log_too_large_when_decompressed(self, node, testapp):
+        data = {
+            'line': 1,
+            'message': 'A' * 4096,
+            'severity': 1,
+            'filename': 'foobar.cpp'
+        }
+
+        fileobj = io.BytesIO()
+        gzf = gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+        gzf.write(json.dumps({
+            'node_key': node.node_key,
+            'data': [data] * 16,
+            'log_type': 'status',
+        }).encode('utf-8'))
+        gzf.close()
+
+        with mock.patch.dict(testapp.app.config, {
+                'DOORMAN_MAX_DECOMPRESSED_SIZE': 4096}):
+            resp = testapp.post(url_for('api.logger'), fileobj.getvalue(), headers={
+                'Content-Encoding': 'gzip',
+                'Content-Type': 'application/json'
+            }, expect_errors=True)
+
+        assert resp.status_int == 413
+        assert not node.status_logs.count()
+
     def test_no_status_log_created_when_data_is_empty(self, node, testapp):
         assert not node.status_logs.count()
 
@@ -526,6 +746,167 @@ class TestLogging:
         assert removed.action == 'removed'
         assert removed.columns == data[0]['diffResults']['removed'][0]
 
+    def test_result_log_created_for_node_with_copy(self, node, testapp):
+        now = dt.datetime.utcnow()
+
+        data = [
+            {
+              "diffResults": {
+                "added": [
+                  {
+                    "name": "osqueryd",
+                    "path": "/usr/local/bin/osqueryd\ttab\\slash",
+                    "pid": "97830"
+                  }
+                ],
+                "removed": [
+                  {
+                    "name": "osqueryd",
+                    "path": "/usr/local/bin/osqueryd",
+                    "pid": "97650"
+                  }
+                ]
+              },
+              "name": "processes",
+              "hostIdentifier": "hostname.local",
+              "calendarTime": "%s %s" % (now.ctime(), "UTC"),
+              "unixTime": now.strftime('%s')
+            }
+        ]
+
+        assert not node.result_logs.count()
+
+        with mock.patch.dict(testapp.app.config,
+                             {'DOORMAN_RESULT_LOG_INGESTION': 'copy'}):
+            resp = testapp.post_json(url_for('api.logger'), {
+                'node_key': node.node_key,
+                'data': data,
+                'log_type': 'result',
+            },
+            extra_environ=dict(REMOTE_ADDR='127.0.0.2')
+            )
+
+        assert resp.json == {'node_invalid': False}
+        assert node.result_logs.count() == 2
+        assert node.last_ip == '127.0.0.2'
+
+        added, removed = node.result_logs.all()
+
+        assert added.timestamp == now.replace(microsecond=0)
+        assert added.name == data[0]['name']
+        assert added.action == 'added'
+        assert added.columns == data[0]['diffResults']['added'][0]
+
+        assert removed.timestamp == now.replace(microsecond=0)
+        assert removed.action == 'removed'
+        assert removed.columns == data[0]['diffResults']['removed'][0]
+
+    def test_result_log_written_behind_when_buffered(self, node, testapp):
+        from doorman.extensions import IngestBuffer
+
+        now = dt.datetime.utcnow()
+
+        data = [
+            {
+              "action": "added",
+              "columns": {
+                "name": "osqueryd",
+                "path": "/usr/local/bin/osqueryd",
+                "pid": "97830"
+              },
+              "name": "processes",
+              "hostIdentifier": "hostname.local",
+              "calendarTime": "%s %s" % (now.ctime(), "UTC"),
+              "unixTime": now.strftime('%s')
+            }
+        ]
+
+        buffer = IngestBuffer()
+        with mock.patch.dict(testapp.app.config,
+                             {'DOORMAN_INGEST_BUFFER_ENABLED': True}):
+            buffer.init_app(testapp.app)
+
+        with mock.patch('doorman.api.ingest_buffer', buffer):
+            resp = testapp.post_json(url_for('api.logger'), {
+                'node_key': node.node_key,
+                'data': data,
+                'log_type': 'result',
+            },
+            extra_environ=dict(REMOTE_ADDR='127.0.0.2')
+            )
+
+        assert resp.json == {'node_invalid': False}
+
+        # stopping the buffer flushes anything still queued
+        buffer.stop()
+
+        assert node.result_logs.count() == 1
+        assert node.result_logs[0].columns == data[0]['columns']
+        assert node.last_ip == '127.0.0.2'
+
+    def test_buffered_logs_written_despite_bad_payload(self, db, node, testapp):
+        from doorman.extensions import IngestBuffer, PendingLog
+
+        data = {
+            'line': 1,
+            'message': 'This is a test of the emergency broadcast system.',
+            'severity': 1,
+            'filename': 'foobar.cpp'
+        }
+        now = dt.datetime.utcnow()
+
+        buffer = IngestBuffer(testapp.app)
+        # the first payload is for a node that doesn't exist, so its batch
+        # can't be written
+        batch = [
+            PendingLog(log_type='status', node_id=node.id + 1, data=[data],
+                       last_checkin=now, last_ip='127.0.0.3'),
+            PendingLog(log_type='status', node_id=node.id, data=[data],
+                       last_checkin=now, last_ip='127.0.0.2'),
+        ]
+
+        # flush from another thread, as the flusher thread would, so that
+        # it doesn't remove the test's session
+        thread = threading.Thread(target=buffer.flush, args=(batch, ))
+        thread.start()
+        thread.join()
+        db.session.expire(node)
+
+        assert node.status_logs.count() == 1
+        assert node.status_logs[0].message == data['message']
+        assert node.last_ip == '127.0.0.2'
+
+    def test_invalid_logs_rejected(self, node, testapp):
+        now = dt.datetime.utcnow()
+
+        resp = testapp.post_json(url_for('api.logger'), {
+            'node_key': node.node_key,
+            'data': [{
+                'line': 'foo',
+                'message': 'This is a test of the emergency broadcast system.',
+                'severity': 1,
+                'filename': 'foobar.cpp'
+            }],
+            'log_type': 'status',
+        }, expect_errors=True)
+
+        assert resp.status_int == 400
+        assert not node.status_logs.count()
+
+        resp = testapp.post_json(url_for('api.logger'), {
+            'node_key': node.node_key,
+            'data': [{
+                'action': 'added',
+                'columns': {'name': 'osqueryd'},
+                'name': 'processes',
+                'unixTime': now.strftime('%s')
+            }],
+            'log_type': 'result',
+        }, expect_errors=True)
+
+        assert resp.status_int == 400
+        assert not node.result_logs.count()
+
     def test_no_result_log_created_when_data_is_empty(self, node, testapp):
         assert not node.result_logs.count()
 
@@ -827,6 +1208,45 @@ class TestDistributedRead:
 
         assert doorman.utils.dt.datetime.utcnow() != not_before
 
+    def test_idle_node_does_not_query_tasks(self, db, node, testapp):
+        from doorman.extensions import PendingWork
+
+        pending_work = PendingWork()
+        with mock.patch.dict(testapp.app.config, {
+                'DOORMAN_PENDING_WORK_BACKEND': 'memory'}):
+            pending_work.init_app(testapp.app)
+
+        with mock.patch('doorman.api.pending_work', pending_work):
+            with mock.patch('doorman.utils.assemble_distributed_queries') as mock_assemble:
+                resp = testapp.post_json(url_for('api.distributed_read'), {
+                    'node_key': node.node_key,
+                })
+                assert not resp.json['queries']
+                assert not mock_assemble.called
+
+            q = DistributedQuery.create(sql='select * from osquery_info;')
+            t = DistributedQueryTask.create(node=node, distributed_query=q)
+            pending_work.mark(node.id)
+
+            resp = testapp.post_json(url_for('api.distributed_read'), {
+                'node_key': node.node_key,
+            })
+            assert t.guid in resp.json['queries']
+            assert not pending_work.has_work(node.id)
+
+    def test_pending_work_synced_from_database(self, db, node, app):
+        from doorman.extensions import PendingWork
+
+        q = DistributedQuery.create(sql='select * from osquery_info;')
+        DistributedQueryTask.create(node=node, distributed_query=q)
+
+        pending_work = PendingWork()
+        with mock.patch.dict(app.config, {
+                'DOORMAN_PENDING_WORK_BACKEND': 'memory'}):
+            pending_work.init_app(app)
+
+        assert pending_work.has_work(node.id)
+
 
 class TestDistributedWrite:
 
@@ -894,6 +1314,37 @@ class TestDistributedWrite:
         assert q.results[1].columns == data[1]
         assert node.last_ip == '127.0.0.2'
 
+    def test_distributed_query_write_with_copy(self, db, node, testapp):
+        q = DistributedQuery.create(
+            sql="select name, path, pid from processes where name = 'osqueryd';")
+        t1 = DistributedQueryTask.create(node=node, distributed_query=q)
+        t2 = DistributedQueryTask.create(node=node, distributed_query=q)
+        t1.update(status=DistributedQueryTask.PENDING)
+        t2.update(status=DistributedQueryTask.PENDING)
+
+        data = [{
+            "name": "osqueryd",
+            "path": "/usr/local/bin/osqueryd",
+            "pid": "97830"
+        }]
+
+        with mock.patch.dict(testapp.app.config, {
+                'DOORMAN_RESULT_LOG_INGESTION': 'copy'}):
+            resp = testapp.post_json(url_for('api.distributed_write'), {
+                'node_key': node.node_key,
+                'queries': {
+                    t1.guid: data,
+                    t2.guid: '',
+                }
+            })
+
+        assert resp.json == {'node_invalid': False}
+        assert t1.status == DistributedQueryTask.COMPLETE
+        assert t2.status == DistributedQueryTask.COMPLETE
+        assert len(t1.results) == 1
+        assert t1.results[0].columns == data[0]
+        assert not t2.results
+
     def test_distributed_query_write_state_complete(self, db, node, testapp):
         q = DistributedQuery.create(
             sql="select name, path, pid from processes where name = 'osqueryd';")
@@ -973,6 +1424,42 @@ class TestDistributedWrite:
         assert foo.last_ip == '127.0.0.3'
 
 
+class TestAddDistributedQuery:
+
+    def test_node_matching_node_and_tag_gets_one_task(self, db, node, testapp):
+        tag = TagFactory(value='foobar')
+        node.tags.append(tag)
+        node.save()
+        other = NodeFactory(host_identifier='other')
+        NodeFactory(host_identifier='untagged')
+        other.tags.append(tag)
+        other.save()
+
+        resp = testapp.post(url_for('manage.add_distributed'), {
+            'sql': 'select * from osquery_info;',
+            'nodes': [node.node_key],
+            'tags': [tag.value],
+        })
+        assert resp.status_int == 302
+
+        q = DistributedQuery.query.one()
+        tasks = q.tasks.all()
+        assert sorted(t.node_id for t in tasks) == sorted([node.id, other.id])
+        assert len(set(t.guid for t in tasks)) == 2
+        assert all(t.status == DistributedQueryTask.NEW for t in tasks)
+
+    def test_all_nodes_get_query_by_default(self, db, node, testapp):
+        NodeFactory(host_identifier='other')
+
+        resp = testapp.post(url_for('manage.add_distributed'), {
+            'sql': 'select * from osquery_info;',
+        })
+        assert resp.status_int == 302
+
+        q = DistributedQuery.query.one()
+        assert q.tasks.count() == Node.query.count() == 2
+
+
 class TestDistributedTable:
 
     def html_escape(self, v):
@@ -1255,6 +1742,7 @@ class TestAddRule:
 
         assert resp.status_int == 302       # Redirect on success
         assert Rule.query.count() == 1
+        assert get_generation(RULES_GENERATION) == 1
 
 
 class TestUpdateRule:
@@ -1336,6 +1824,284 @@ class TestRuleManager:
         # Verify that we will now reload
         assert mgr.should_reload_rules() is True
 
+    def test_will_reload_when_deleted(self, app, db):
+        from doorman.models import Rule
+
+        mgr = app.rule_manager
+        rule = Rule.create(name='foo', alerters=[],
+                           conditions={'condition': 'AND', 'rules': [{
+                               'field': 'query_name',
+                               'operator': 'equal',
+                               'value': 'dummy-query',
+                           }]},
+                           updated_at=dt.datetime.utcnow())
+
+        mgr.load_rules()
+        assert mgr.network.alert_conditions
+
+        rule.delete()
+
+        assert mgr.should_reload_rules() is True
+        mgr.load_rules()
+        assert not mgr.network.alert_conditions
+
+    def test_will_keep_rule_snapshots(self, app, db):
+        from doorman.models import Rule
+
+        mgr = app.rule_manager
+        rule = Rule.create(name='foo', alerters=['debug'], description='bar',
+                           conditions={'condition': 'AND', 'rules': [{
+                               'field': 'query_name',
+                               'operator': 'equal',
+                               'value': 'dummy-query',
+                           }]},
+                           updated_at=dt.datetime.utcnow())
+
+        mgr.load_rules()
+        snapshot = mgr.rules[rule.id]
+        assert snapshot.id == rule.id
+        assert snapshot.name == 'foo'
+        assert snapshot.description == 'bar'
+        assert snapshot.alerters == ('debug', )
+        assert snapshot.template.template == rule.template.template
+
+    def test_will_check_for_changes_every_interval(self, app, db):
+        from doorman.models import Rule
+
+        mgr = app.rule_manager
+        mgr.load_rules()
+        Rule.create(name='foo', alerters=[],
+                    conditions={'condition': 'AND', 'rules': [{
+                        'field': 'query_name',
+                        'operator': 'equal',
+                        'value': 'dummy-query',
+                    }]},
+                    updated_at=dt.datetime.utcnow())
+
+        with mock.patch.object(mgr, 'reload_interval', 60):
+            with mock.patch('doorman.utils.get_generation',
+                            wraps=get_generation) as mock_get_generation:
+                assert mgr.should_reload_rules() is False
+                assert not mock_get_generation.called
+
+                mgr.checked_at -= 60
+                assert mgr.should_reload_rules() is True
+                mock_get_generation.assert_called_once_with(RULES_GENERATION)
+
+
+class TestAlertThrottle:
+
+    def make_throttle(self, app, **config):
+        from doorman.extensions import AlertThrottle
+
+        throttle = AlertThrottle()
+        config.setdefault('DOORMAN_ALERT_THROTTLE_BACKEND', 'memory')
+        with mock.patch.dict(app.config, config):
+            throttle.init_app(app)
+        return throttle
+
+    def make_log(self, *paths):
+        now = dt.datetime.utcnow()
+        return {
+            'data': [{
+                'snapshot': [{'path': path} for path in paths],
+                'name': 'dummy-query',
+                'hostIdentifier': 'hostname.local',
+                'calendarTime': '%s %s' % (now.ctime(), 'UTC'),
+                'unixTime': now.strftime('%s'),
+            }],
+        }
+
+    def test_will_suppress_repeated_alerts(self, app, db):
+        from doorman.models import Rule
+
+        mgr = app.rule_manager
+        Rule.create(name='foo', alerters=['debug'],
+                    conditions={'condition': 'AND', 'rules': [{
+                        'field': 'query_name',
+                        'operator': 'equal',
+                        'value': 'dummy-query',
+                    }]},
+                    updated_at=dt.datetime.utcnow())
+        throttle = self.make_throttle(app, DOORMAN_ALERT_THROTTLE_KEY_COLUMNS={
+            'foo': ['path'],
+        })
+        node = {'host_identifier': 'foo'}
+
+        with mock.patch('doorman.extensions.alert_throttle', throttle), \
+                mock.patch.object(mgr.alerters['debug'], 'handle_alert') as mock_handle_alert:
+            mgr.handle_log_entry(self.make_log('/bin/a', '/bin/a', '/bin/b', '/bin/a'), node)
+            assert sorted(call[0][1].result['columns']['path']
+                          for call in mock_handle_alert.call_args_list) == ['/bin/a', '/bin/b']
+            assert all(call[0][1].suppressed == 0
+                       for call in mock_handle_alert.call_args_list)
+
+            # once the window has passed, the next alert counts the others
+            mock_handle_alert.reset_mock()
+            with mock.patch('time.time', return_value=time.time() + 300):
+                mgr.handle_log_entry(self.make_log('/bin/a'), node)
+
+            assert mock_handle_alert.call_count == 1
+            assert mock_handle_alert.call_args[0][1].suppressed == 2
+
+    def test_will_key_on_rule_and_node(self, app, db):
+        from doorman.rules import RuleSnapshot
+
+        throttle = self.make_throttle(app)
+        rules = [RuleSnapshot(id=i, name='rule', description=None,
+                              alerters=('debug', ), template=None)
+                 for i in (1, 2)]
+        result = {'columns': {'path': '/bin/a'}}
+
+        assert throttle.check(rules[0], {'host_identifier': 'foo'}, result) == 0
+        assert throttle.check(rules[0], {'host_identifier': 'foo'}, result) is None
+        assert throttle.check(rules[1], {'host_identifier': 'foo'}, result) == 0
+        assert throttle.check(rules[0], {'host_identifier': 'bar'}, result) == 0
+
+    def test_will_not_throttle_when_disabled(self, app):
+        throttle = self.make_throttle(app, DOORMAN_ALERT_THROTTLE_BACKEND=None)
+        assert not throttle.enabled
+        assert throttle.check(None, None, None) == 0
+
+
+class TestDispatchAlert:
+
+    def setup_method(self, _method):
+        self.result = {
+            'name': 'dummy-query',
+            'action': 'added',
+            'timestamp': dt.datetime.utcnow().replace(microsecond=0),
+            'columns': {'column_name': 'column_value'},
+        }
+        # as the result is sent to the task
+        self.payload = dict(self.result,
+                            timestamp=self.result['timestamp'].isoformat())
+
+    def make_rule(self):
+        from doorman.models import Rule
+        return Rule.create(name='foo', alerters=['debug'],
+                           conditions={'condition': 'AND', 'rules': [{
+                               'field': 'query_name',
+                               'operator': 'equal',
+                               'value': 'dummy-query',
+                           }]},
+                           updated_at=dt.datetime.utcnow())
+
+    def test_will_queue_alerts_per_alerter(self, app, db, node):
+        from doorman.rules import RuleMatch
+        from doorman.tasks import dispatch_alert
+
+        mgr = app.rule_manager
+        rule = self.make_rule()
+        mgr.load_rules()
+        match = RuleMatch(rule=mgr.rules[rule.id], result=self.result,
+                          node=node.to_dict())
+
+        with mock.patch.object(mgr, 'dispatch_enabled', True), \
+                mock.patch.object(dispatch_alert, 'apply_async') as mock_apply_async, \
+                mock.patch.object(mgr.alerters['debug'], 'handle_alert') as mock_handle_alert:
+            mgr.trigger('debug', node.to_dict(), match)
+
+        assert not mock_handle_alert.called
+        mock_apply_async.assert_called_once_with(
+            ('debug', node.to_dict(), rule.id, self.payload, 0),
+            queue='alerts.debug', soft_time_limit=60)
+
+    def test_will_deliver_alert(self, app, db, node):
+        from doorman.tasks import dispatch_alert
+
+        rule = self.make_rule()
+        alerter = app.rule_manager.alerters['debug']
+
+        with mock.patch.object(alerter, 'handle_alert') as mock_handle_alert:
+            dispatch_alert('debug', node.to_dict(), rule.id, self.payload)
+
+        assert mock_handle_alert.call_count == 1
+        _, match = mock_handle_alert.call_args[0]
+        assert match.rule.id == rule.id
+        assert match.result == self.result
+
+    def test_will_reload_rules_for_new_rule(self, app, db, node):
+        from doorman.tasks import dispatch_alert
+
+        mgr = app.rule_manager
+        mgr.load_rules()
+        rule = self.make_rule()
+        alerter = mgr.alerters['debug']
+
+        with mock.patch.object(mgr, 'reload_interval', 3600), \
+                mock.patch.object(alerter, 'handle_alert') as mock_handle_alert:
+            dispatch_alert('debug', node.to_dict(), rule.id, self.payload)
+
+        assert mock_handle_alert.call_count == 1
+        _, match = mock_handle_alert.call_args[0]
+        assert match.rule.id == rule.id
+
+    def test_will_retry_failed_delivery(self, app, db, node):
+        from celery.exceptions import Retry
+        from doorman.tasks import dispatch_alert
+
+        rule = self.make_rule()
+        alerter = app.rule_manager.alerters['debug']
+        error = IOError('timed out')
+
+        with mock.patch.object(alerter, 'handle_alert', side_effect=error), \
+                mock.patch.object(dispatch_alert, 'retry', return_value=Retry()) as mock_retry:
+            with pytest.raises(Retry):
+                dispatch_alert('debug', node.to_dict(), rule.id, self.payload)
+
+        mock_retry.assert_called_once_with(exc=error, countdown=30, max_retries=5)
+
+    def test_will_queue_failed_digests(self, app, db, node):
+        from doorman.rules import RuleMatch
+        from doorman.tasks import dispatch_digest
+
+        mgr = app.rule_manager
+        rule = self.make_rule()
+        mgr.load_rules()
+        match = RuleMatch(rule=mgr.rules[rule.id], result=self.result,
+                          node=node.to_dict())
+
+        with mock.patch.object(dispatch_digest, 'apply_async') as mock_apply_async:
+            mgr.queue_digest('debug', [(node.to_dict(), match)])
+
+        mock_apply_async.assert_called_once_with(
+            ('debug', rule.id, [(node.to_dict(), self.payload, 0)]),
+            soft_time_limit=60)
+
+    def test_will_retry_failed_digest(self, app, db, node):
+        from celery.exceptions import Retry
+        from doorman.tasks import dispatch_digest
+
+        rule = self.make_rule()
+        alerter = app.rule_manager.alerters['debug']
+        error = IOError('timed out')
+
+        with mock.patch.object(alerter, 'send_digest', create=True,
+                               side_effect=error) as mock_send_digest, \
+                mock.patch.object(dispatch_digest, 'retry', return_value=Retry()) as mock_retry:
+            with pytest.raises(Retry):
+                dispatch_digest('debug', rule.id,
+                                [(node.to_dict(), self.payload, 0)])
+
+        (matches, ), _ = mock_send_digest.call_args
+        assert [(n, m.rule.id, m.result) for n, m in matches] == \
+            [(node.to_dict(), rule.id, self.result)]
+        mock_retry.assert_called_once_with(exc=error, countdown=30, max_retries=5)
+
+    def test_will_drop_alerts_for_deleted_rules(self, app, db, node):
+        from doorman.tasks import dispatch_alert
+
+        rule = self.make_rule()
+        rule_id = rule.id
+        rule.delete()
+        alerter = app.rule_manager.alerters['debug']
+
+        with mock.patch.object(alerter, 'handle_alert') as mock_handle_alert:
+            dispatch_alert('debug', node.to_dict(), rule_id, self.payload)
+
+        assert not mock_handle_alert.called
+
 
 class TestRuleEndToEnd:
 
@@ -1350,7 +2116,7 @@ class TestRuleEndToEnd:
         """
         from doorman.models import Rule
         from doorman.plugins import AbstractAlerterPlugin
-        from doorman.rules import RuleMatch
+        from doorman.rules import RuleSnapshot
         from doorman.tasks import analyze_result
 
         # Add a dummy alerter
@@ -1431,6 +2197,7 @@ class TestRuleEndToEnd:
                 assert dummy_alerter.calls[0][0] == node.to_dict()
 
                 rule = Rule.query.first()
+                assert isinstance(dummy_alerter.calls[0][1].rule, RuleSnapshot)
                 assert dummy_alerter.calls[0][1].rule.id == rule.id
                 assert dummy_alerter.calls[0][1].node == node.to_dict()
                 assert dummy_alerter.calls[0][1].result == {
@@ -1565,6 +2332,16 @@ class TestLearning:
         learn_from_result(result, node.to_dict())
         assert 'foobar' not in node.node_info
 
+    def test_node_info_not_updated_when_data_is_empty(self, node, testapp):
+        assert not node.node_info
+
+        with mock.patch('doorman.utils.extract_results') as mock_extract:
+            learn_from_result({'data': None}, node.to_dict())
+            learn_from_result([], node.to_dict())
+
+        assert not mock_extract.called
+        assert not node.node_info
+
 
 class TestCSVExport:
     def test_node_csv_download(self, node, testapp):
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import re
 import datetime as dt
 from collections import defaultdict
 
+import mock
+
 from doorman.rules import (
+    AhoCorasick,
+    AndCondition,
     BaseCondition,
+    ContainsCondition,
     EqualCondition,
     LessCondition,
     GreaterEqualCondition,
@@ -13,6 +19,8 @@ from doorman.rules import (
     MatchesRegexCondition,
     Network,
     NotMatchesRegexCondition,
+    OrCondition,
+    RegexGroup,
     RuleInput,
 )
 
@@ -281,6 +289,242 @@ class TestNetwork:
         assert isinstance(exc, ValueError)
         assert exc.args == ("Unsupported operator: BAD OPERATOR",)
 
+    def test_will_evaluate_shared_conditions_once(self):
+        class CountingCondition(BaseCondition):
+            runs = 0
+
+            def local_run(self, input):
+                CountingCondition.runs += 1
+                return input.result_log['name'] == 'foo'
+
+        network = Network()
+        shared = network.make_condition(CountingCondition)
+        for rule_id in (1, 2, 3):
+            network.make_alert_condition('debug', network.make_condition(
+                AndCondition, [shared]), rule_id=rule_id)
+
+        alerts = network.process({'name': 'foo'}, {})
+        assert sorted(alerts) == [('debug', 1), ('debug', 2), ('debug', 3)]
+        assert CountingCondition.runs == 1
+
+        assert not network.process({'name': 'bar'}, {})
+        assert CountingCondition.runs == 2
+
+    def test_will_recompile_when_rules_are_added(self):
+        network = Network()
+        network.make_alert_condition('debug', network.make_condition(
+            EqualCondition, 'query_name', 'foo'), rule_id=1)
+        assert network.process({'name': 'foo'}, {}) == set([('debug', 1)])
+
+        network.make_alert_condition('debug', network.make_condition(
+            EqualCondition, 'action', 'added'), rule_id=2)
+        assert network.process({'name': 'foo', 'action': 'added'}, {}) == \
+            set([('debug', 1), ('debug', 2)])
+
+    def test_will_only_evaluate_candidate_rules(self):
+        class CountingCondition(BaseCondition):
+            runs = 0
+
+            def local_run(self, input):
+                CountingCondition.runs += 1
+                return True
+
+        network = Network()
+        counting = network.make_condition(CountingCondition)
+        foo = network.make_condition(EqualCondition, 'query_name', 'foo')
+        bar = network.make_condition(EqualCondition, 'query_name', 'bar')
+        added = network.make_condition(EqualCondition, 'action', 'added')
+
+        network.make_alert_condition('debug', network.make_condition(
+            AndCondition, [foo, added, counting]), rule_id=1)
+        network.make_alert_condition('debug', network.make_condition(
+            AndCondition, [network.make_condition(OrCondition, [foo, bar]),
+                           counting]), rule_id=2)
+        network.make_alert_condition('debug', network.make_condition(
+            OrCondition, [foo, counting]), rule_id=3)
+
+        network.compile()
+        assert sorted(network.by_query_name) == ['bar', 'foo']
+        assert [compiled[2] for compiled in network.catch_all] == [3]
+
+        assert network.process({'name': 'baz', 'action': 'added'}, {}) == \
+            set([('debug', 3)])
+        assert network.process({'name': 'bar', 'action': 'added'}, {}) == \
+            set([('debug', 2), ('debug', 3)])
+        assert network.process({'name': 'foo', 'action': 'removed'}, {}) == \
+            set([('debug', 2), ('debug', 3)])
+        assert network.process({'name': 'foo', 'action': 'added'}, {}) == \
+            set([('debug', 1), ('debug', 2), ('debug', 3)])
+
+    def test_will_convert_each_value_once(self):
+        class CountingCondition(GreaterEqualCondition):
+            conversions = 0
+
+            def maybe_make_number(self, value):
+                CountingCondition.conversions += 1
+                return super(CountingCondition, self).maybe_make_number(value)
+
+        network = Network()
+        for rule_id, expected in enumerate(('1', '2', '3')):
+            network.make_alert_condition('debug', network.make_condition(
+                CountingCondition, 'column', expected, column_name='pid'),
+                rule_id=rule_id)
+        network.make_alert_condition('debug', network.make_condition(
+            EqualCondition, 'column', 'foo', column_name='pid'), rule_id=3)
+
+        network.compile()
+        CountingCondition.conversions = 0
+
+        entry = {'name': 'foo', 'columns': {'pid': '2'}}
+        assert network.process(entry, {}) == set([('debug', 0), ('debug', 1)])
+        assert CountingCondition.conversions == 1
+
+        assert network.process_batch([entry, entry], {}) == \
+            [set([('debug', 0), ('debug', 1)])] * 2
+        assert CountingCondition.conversions == 3
+
+    def test_grouped_conditions_match_individual_conditions(self):
+        network = Network()
+        network.pattern_group_min_size = 2
+
+        patterns = ['foo', 'oba', 'bar', 'foobar', 'o', '/usr/', '/usr/bin']
+        rule_id = 0
+        for operator in ('contains', 'not_contains', 'begins_with',
+                         'not_begins_with', 'matches_regex', 'not_matches_regex'):
+            for pattern in patterns:
+                if operator.endswith('regex'):
+                    pattern = '.*' + pattern
+                rule_id += 1
+                network.parse_query({
+                    'condition': 'AND',
+                    'rules': [{
+                        'field': 'column',
+                        'operator': 'column_' + operator,
+                        'value': ['path', pattern],
+                    }],
+                }, alerters=['debug'], rule_id=rule_id)
+
+        network.compile()
+        # one slot for the path, and one for each group
+        assert network.memo_size == len(network.conditions) + 1 + 3
+
+        for path in ('', 'foobar', '/usr/bin/foobar', '/usr/local/bin/baz', 'o'):
+            entry = {'name': 'foo', 'columns': {'path': path}}
+            expected = set(
+                ('debug', rule_id) for _, upstream, rule_id in network.alert_conditions
+                if upstream.upstream[0].compare(path))
+            assert network.process(entry, {}) == expected
+            assert network.process_batch([entry], {}) == [expected]
+
+    def test_will_not_group_patterns_with_inline_flags(self):
+        network = Network()
+        network.pattern_group_min_size = 2
+
+        patterns = ['(?x) foo \\  bar', 'a b c', 'x y']
+        for rule_id, pattern in enumerate(patterns):
+            network.parse_query({
+                'condition': 'AND',
+                'rules': [{
+                    'field': 'column',
+                    'operator': 'column_matches_regex',
+                    'value': ['path', pattern],
+                }],
+            }, alerters=['debug'], rule_id=rule_id)
+
+        network.compile()
+        flagged = [upstream.upstream[0] for _, upstream, rule_id
+                   in network.alert_conditions if rule_id == 0][0]
+        assert not RegexGroup.accepts(flagged)
+
+        for rule_id, path in enumerate(('foo bar', 'a b c', 'x y')):
+            entry = {'name': 'foo', 'columns': {'path': path}}
+            assert network.process(entry, {}) == set([('debug', rule_id)])
+            assert network.process_batch([entry], {}) == [set([('debug', rule_id)])]
+
+    def test_will_fall_back_when_too_many_groups(self):
+        network = Network()
+        network.pattern_group_min_size = 2
+
+        # each pattern has a group, so combined they have more than the
+        # 100 groups that Python 2 can compile
+        patterns = ['(x{0})+y'.format(i) for i in range(101)]
+        for rule_id, pattern in enumerate(patterns):
+            network.parse_query({
+                'condition': 'AND',
+                'rules': [{
+                    'field': 'column',
+                    'operator': 'column_matches_regex',
+                    'value': ['path', pattern],
+                }],
+            }, alerters=['debug'], rule_id=rule_id)
+
+        compile_regex = re.compile
+
+        def compile_limited(pattern, flags=0):
+            compiled = compile_regex(pattern, flags)
+            if compiled.groups > 100:
+                raise AssertionError('sorry, but this version only supports '
+                                     '100 named groups')
+            return compiled
+
+        with mock.patch.object(re, 'compile', side_effect=compile_limited):
+            network.compile()
+
+        for path in ('x0y', 'x100x100y', 'x101y', ''):
+            entry = {'name': 'foo', 'columns': {'path': path}}
+            expected = set(
+                ('debug', rule_id) for rule_id, pattern in enumerate(patterns)
+                if compile_regex(pattern).match(path))
+            assert network.process(entry, {}) == expected
+            assert network.process_batch([entry], {}) == [expected]
+
+    def test_batch_will_match_process(self):
+        class CountingCondition(BaseCondition):
+            runs = 0
+
+            def local_run(self, input):
+                CountingCondition.runs += 1
+                return input.result_log['columns']['pid'] != '0'
+
+        network = Network()
+        counting = network.make_condition(CountingCondition)
+        foo = network.make_condition(EqualCondition, 'query_name', 'foo')
+        added = network.make_condition(EqualCondition, 'action', 'added')
+        path = network.make_condition(ContainsCondition, 'column', 'bin',
+                                      column_name='path')
+
+        network.make_alert_condition('debug', network.make_condition(
+            AndCondition, [foo, added, counting]), rule_id=1)
+        network.make_alert_condition('debug', network.make_condition(
+            AndCondition, [network.make_condition(OrCondition, [path, counting]),
+                           foo]), rule_id=2)
+        network.make_alert_condition('debug', network.make_condition(
+            OrCondition, [added, path]), rule_id=3)
+
+        entries = []
+        for name in ('foo', 'bar'):
+            for action in ('added', 'removed'):
+                for pid, path in (('0', '/bin/sh'), ('1', '/tmp/sh'), ('2', '')):
+                    entries.append({'name': name, 'action': action,
+                                    'columns': {'pid': pid, 'path': path}})
+
+        expected = [network.process(entry, {}) for entry in entries]
+        runs, CountingCondition.runs = CountingCondition.runs, 0
+
+        assert network.process_batch(entries, {}) == expected
+        assert CountingCondition.runs == runs
+        assert network.process_batch([], {}) == []
+
+
+class TestAhoCorasick:
+
+    def test_finds_overlapping_patterns(self):
+        automaton = AhoCorasick(['he', 'she', 'his', 'hers'])
+        assert automaton.search('ushers') == set(['she', 'he', 'hers'])
+        assert automaton.search('this') == set(['his'])
+        assert automaton.search('nothing') == set()
+        assert automaton.search('') == set()
+
 
 class TestBaseCondition:
 
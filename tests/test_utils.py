@@ -2,12 +2,19 @@
 import json
 import datetime as dt
 
+import mock
 import pytest
 from flask import current_app
 
 from doorman.utils import (
+    CopyStream,
     DateTimeEncoder,
+    Field,
+    ResultBatch,
+    copy_escape,
+    extract_results,
     osquery_mock_db,
+    parse_calendar_time,
     quote,
     validate_osquery_query,
 )
@@ -77,3 +84,93 @@ class TestDateTimeEncoder:
 
         s = json.dumps(data, cls=DateTimeEncoder)
         assert s == '{"foo": "2016-05-16T11:11:11"}'
+
+
+class TestCopyStream:
+
+    def test_will_escape_values(self):
+        assert copy_escape(None) == '\\N'
+        assert copy_escape('foo\tbar\nbaz') == 'foo\\tbar\\nbaz'
+        assert copy_escape('C:\\Windows') == 'C:\\\\Windows'
+        assert copy_escape(1) == '1'
+        assert copy_escape({'foo': 'bar'}) == '{"foo": "bar"}'
+        assert copy_escape(dt.datetime(2016, 5, 16, 11, 11, 11)) == '2016-05-16T11:11:11'
+
+    def test_will_read_rows_in_chunks(self):
+        rows = [('foo', 1), ('bar', None), ('baz', 3)]
+        stream = CopyStream(iter(rows))
+
+        chunks = []
+        while True:
+            chunk = stream.read(4)
+            if not chunk:
+                break
+            assert len(chunk) <= 4
+            chunks.append(chunk)
+
+        assert b''.join(chunks) == b'foo\t1\nbar\t\\N\nbaz\t3\n'
+        assert stream.count == 3
+
+
+class TestParseCalendarTime:
+
+    def test_matches_strptime(self):
+        for value in ('Mon Jul 18 09:59:06 2016 UTC',
+                      'Mon Jul  4 00:00:00 2016 UTC',
+                      'Thu Dec 31 23:59:59 2015 UTC'):
+            assert parse_calendar_time(value) == \
+                dt.datetime.strptime(value, '%a %b %d %H:%M:%S %Y UTC')
+
+    def test_ctime(self):
+        now = dt.datetime.utcnow().replace(microsecond=0)
+        assert parse_calendar_time('%s UTC' % now.ctime()) == now
+
+    def test_invalid(self):
+        for value in ('', 'Mon Jul 18 09:59:06 2016', 'Mon Foo 18 09:59:06 2016 UTC',
+                      'Mon Jul 18 09:59 2016 UTC', 'Mon Jul 32 09:59:06 2016 UTC'):
+            with pytest.raises(ValueError):
+                parse_calendar_time(value)
+
+
+class TestResultBatch:
+
+    RESULT = {
+        'data': [
+            {
+                'diffResults': {
+                    'added': [{'foo': 'bar'}],
+                    'removed': [{'foo': 'baz'}],
+                },
+                'name': 'foobar',
+                'hostIdentifier': 'hostname.local',
+                'calendarTime': 'Mon Jul 18 09:59:06 2016 UTC',
+                'unixTime': '1468835946',
+            },
+        ],
+    }
+
+    def test_fields_are_extracted_once(self):
+        batch = ResultBatch(self.RESULT)
+        assert list(extract_results(batch)) == list(extract_results(self.RESULT))
+
+        with mock.patch('doorman.utils._extract_results') as mock_extract:
+            assert list(extract_results(batch)) == list(batch.fields)
+            assert not mock_extract.called
+
+    def test_validate(self):
+        ResultBatch(self.RESULT).validate()
+
+        for entry in ({'name': 'foobar'}, {'calendarTime': 'foo'}, None):
+            with pytest.raises(ValueError):
+                ResultBatch({'data': [entry]}).validate()
+
+    def test_rows(self):
+        batch = ResultBatch(self.RESULT)
+        rows = batch.rows()
+        assert [row[3] for row in rows] == ['2016-07-18T09:59:06'] * 2
+        assert list(extract_results(rows)) == [
+            Field(name='foobar', action='added', columns={'foo': 'bar'},
+                  timestamp=dt.datetime(2016, 7, 18, 9, 59, 6)),
+            Field(name='foobar', action='removed', columns={'foo': 'baz'},
+                  timestamp=dt.datetime(2016, 7, 18, 9, 59, 6)),
+        ]